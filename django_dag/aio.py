@@ -0,0 +1,115 @@
+"""
+Async variants of the traversal API, for nodes used from async views.
+
+Every method runs its queries in a single hop to the thread owning the
+database connection, through asgiref's sync_to_async (a dependency of
+Django 3.0+), instead of one hop per query. On the python backend the
+frontiers of descendants and ancestors are split into chunks fetched
+concurrently, each on its own connection, when the database allows it:
+outside transactions and not on SQLite.
+
+NodeBase gets these methods when asgiref can be imported.
+"""
+
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+# Primary keys of a frontier fetched by each concurrent query
+FRONTIER_CHUNK = 200
+
+
+def _concurrent(node_model):
+    """
+    Checks if queries can run on other threads: their connections don't
+    see the uncommitted data of a transaction
+    """
+    connection = node_model._dag_connection()
+    return (node_model._dag_get_backend() == 'python' and node_model.dag_cache is None and
+            connection.vendor != 'sqlite' and not connection.in_atomic_block)
+
+
+def _frontier_adjacency(node_model, pks, reverse):
+    """
+    Fetches the edges of a frontier chunk on an executor thread. Request
+    signals don't reach these threads: their connections are closed, or
+    kept per CONN_MAX_AGE, as around a request.
+    """
+    close_old_connections()
+    try:
+        return node_model._dag_adjacency(pks, reverse)
+    finally:
+        close_old_connections()
+
+
+class AsyncNodeMixin(object):
+    """
+    Async methods of NodeBase
+    """
+
+    async def _adag_reachable(self, reverse, ids_only):
+        cls = self.__class__
+        name = 'ancestors_set' if reverse else 'descendants_set'
+        if not await sync_to_async(_concurrent)(cls):
+            return await sync_to_async(getattr(self, name))(ids_only=ids_only)
+        adjacency = sync_to_async(_frontier_adjacency, thread_sensitive=False)
+        reached = set()
+        frontier = [self.pk]
+        while frontier:
+            levels = await asyncio.gather(*[adjacency(cls, frontier[i:i + FRONTIER_CHUNK], reverse)
+                                            for i in range(0, len(frontier), FRONTIER_CHUNK)])
+            frontier = list(set(n for rows in levels for pk, n in rows) - reached)
+            reached.update(frontier)
+        if ids_only:
+            return frozenset(reached)
+        nodes = await sync_to_async(cls.objects.in_bulk)(list(reached))
+        return set(nodes.values())
+
+    async def adescendants_set(self, ids_only=False):
+        """
+        Returns a set of descendants, see descendants_set()
+        """
+        return await self._adag_reachable(False, ids_only)
+
+    async def aancestors_set(self, ids_only=False):
+        """
+        Returns a set of ancestors, see ancestors_set()
+        """
+        return await self._adag_reachable(True, ids_only)
+
+    async def apath(self, target, max_depth=None, bidirectional=True):
+        """
+        Returns the shortest path, see path()
+        """
+        return await sync_to_async(self.path)(target, max_depth, bidirectional)
+
+    async def adistance(self, target, max_depth=None, bidirectional=True):
+        """
+        Returns the shortest hops count to the target vertex, see distance()
+        """
+        return await sync_to_async(self.distance)(target, max_depth, bidirectional)
+
+    async def ais_ancestor_of(self, other):
+        """
+        Checks if other is a descendant, see is_ancestor_of()
+        """
+        return await sync_to_async(self.is_ancestor_of)(other)
+
+    async def aadd_child(self, descendant, **kwargs):
+        """
+        Adds a child, see add_child()
+        """
+        return await sync_to_async(self.add_child)(descendant, **kwargs)
+
+    async def aadd_parent(self, parent, **kwargs):
+        """
+        Adds a parent, see add_parent()
+        """
+        return await sync_to_async(self.add_parent)(parent, **kwargs)
+
+    async def aremove_child(self, descendant):
+        """
+        Removes a child, see remove_child()
+        """
+        return await sync_to_async(self.remove_child)(descendant)
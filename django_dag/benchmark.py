@@ -0,0 +1,215 @@
+"""
+Benchmarks of the graph operations on synthetic DAGs.
+
+Every shape returns the (parent, child) pairs of a graph on the nodes
+numbered 1 to n. run() loads a shape in the node model and measures the
+wall time, the number of queries and the peak memory (Python 3 only) of
+the NodeBase methods and of Edge.save(). The dag_benchmark management
+command runs it in a throwaway test database.
+"""
+
+import random
+from timeit import default_timer
+
+from django.db import connections, router, transaction
+from django.test.utils import CaptureQueriesContext
+
+from .models import NodeNotReachableException
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def chain(n, **kwargs):
+    """
+    1 -> 2 -> ... -> n
+    """
+    return [(i, i + 1) for i in range(1, n)]
+
+
+def fan(n, **kwargs):
+    """
+    1 -> every other node
+    """
+    return [(1, i) for i in range(2, n + 1)]
+
+
+def lattice(n, width=2, **kwargs):
+    """
+    Layers of width nodes, each linked to all the nodes of the next
+    layer: the number of paths grows as width ** layers
+    """
+    return [(i, j) for i in range(1, n + 1)
+            for j in range(((i - 1) // width + 1) * width + 1, ((i - 1) // width + 2) * width + 1)
+            if j <= n]
+
+
+def random_dag(n, edges=None, seed=0, **kwargs):
+    """
+    edges random links from lower to higher nodes, 4 * n by default
+    """
+    rng = random.Random(seed)
+    edges = min(4 * n if edges is None else edges, n * (n - 1) // 2)
+    pairs = set()
+    while len(pairs) < edges:
+        i, j = rng.randint(1, n), rng.randint(1, n)
+        if i != j:
+            pairs.add((min(i, j), max(i, j)))
+    return sorted(pairs)
+
+
+SHAPES = {
+    'chain': chain,
+    'fan': fan,
+    'lattice': lattice,
+    'random': random_dag,
+}
+
+
+def measure(name, func, using='default'):
+    """
+    Runs func, returns a dict with the name, the wall time in seconds,
+    the number of queries and the peak memory in KiB (None without
+    tracemalloc). Tracing slows Python code down several times: the
+    peak memory comes from a second run of func.
+    """
+    with CaptureQueriesContext(connections[using]) as queries:
+        start = default_timer()
+        func()
+        seconds = default_timer() - start
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1] // 1024
+        finally:
+            tracemalloc.stop()
+    return {'name': name, 'seconds': seconds, 'queries': len(queries), 'peak_kb': peak}
+
+
+def load(node_model, pairs, n):
+    """
+    Replaces the nodes and edges of node_model with n nodes linked by pairs
+    """
+    edge_model = node_model.children.through
+    with transaction.atomic(using=router.db_for_write(node_model)):
+        edge_model.objects.all().delete()
+        node_model.objects.all().delete()
+        node_model.objects.bulk_create([node_model(pk=i) for i in range(1, n + 1)], batch_size=500)
+        node_model.bulk_add_edges(pairs)
+
+
+def operations(node_model, n):
+    """
+    Returns the (name, function) pairs measured on a graph of n nodes,
+    from the first node, a middle one and the last one, and on the first
+    edge. Writes are rolled back, every operation sees the same graph.
+
+    add_child() and add_parent() are measured as Edge.save, the async
+    methods, which run the same code in a thread, and circular_checker(),
+    which is is_ancestor_of(), are left out.
+    """
+    first, middle, last = (node_model.objects.get(pk=pk) for pk in (1, (n + 1) // 2, n))
+    edge = node_model.children.through.objects.order_by('pk').first()
+    parent, child = (node_model.objects.get(pk=pk) for pk in edge._dag_node_pks())
+    using = router.db_for_write(node_model)
+
+    def rolled_back(func):
+        def run():
+            with transaction.atomic(using=using):
+                func()
+                transaction.set_rollback(True, using=using)
+        return run
+
+    def save_edge():
+        node = node_model.objects.create()
+        last.add_child(node)
+
+    def bulk_add_edges():
+        node = node_model.objects.create()
+        node_model.bulk_add_edges([(middle, node), (last, node)])
+
+    def reachable(func):
+        def run():
+            try:
+                func(last)
+            except NodeNotReachableException:
+                pass
+        return run
+
+    results = [
+        ('descendants_set', first.descendants_set),
+        ('descendants_set(ids_only)', lambda: first.descendants_set(ids_only=True)),
+        ('ancestors_set', last.ancestors_set),
+        ('descendants', lambda: list(first.descendants())),
+        ('ancestors', lambda: list(last.ancestors())),
+        ('parents', lambda: list(middle.parents())),
+        ('descendants_edges_set', first.descendants_edges_set),
+        ('ancestors_edges_set', last.ancestors_edges_set),
+        ('nodes_set', middle.nodes_set),
+        ('edges_set', middle.edges_set),
+        ('descendants_tree', first.descendants_tree),
+        ('ancestors_tree', last.ancestors_tree),
+        ('iter_descendants', lambda: sum(1 for node in first.iter_descendants())),
+        ('iter_ancestors', lambda: sum(1 for node in last.iter_ancestors())),
+        ('iter_edges', lambda: sum(1 for e in first.iter_edges())),
+        ('is_ancestor_of', lambda: first.is_ancestor_of(last)),
+        ('is_descendant_of', lambda: last.is_descendant_of(first)),
+        ('path', reachable(first.path)),
+        ('distance', reachable(first.distance)),
+        ('all_shortest_paths', reachable(first.all_shortest_paths)),
+        ('common_ancestors', lambda: last.common_ancestors(middle)),
+        ('lowest_common_ancestors', lambda: last.lowest_common_ancestors(middle)),
+        ('common_descendants', lambda: first.common_descendants(middle)),
+        ('highest_common_descendants', lambda: first.highest_common_descendants(middle)),
+        ('get_roots', last.get_roots),
+        ('get_leaves', first.get_leaves),
+        ('is_root', first.is_root),
+        ('is_leaf', last.is_leaf),
+        ('is_island', middle.is_island),
+        ('levels', middle.levels),
+        ('topological_order', lambda: sum(1 for node in middle.topological_order())),
+        ('DagQuerySet.levels', node_model.objects.levels),
+        ('descendants_map', lambda: node_model.descendants_map([first, middle])),
+        ('ancestors_map', lambda: node_model.ancestors_map([middle, last])),
+        ('Edge.save', rolled_back(save_edge)),
+        ('bulk_add_edges', rolled_back(bulk_add_edges)),
+        ('remove_child', rolled_back(lambda: parent.remove_child(child))),
+        ('remove_parent', rolled_back(lambda: child.remove_parent(parent))),
+        ('remove_edges', rolled_back(lambda: node_model.remove_edges([(parent, child)]))),
+        ('detach_all_children', rolled_back(first.detach_all_children)),
+        ('detach_all_parents', rolled_back(last.detach_all_parents)),
+        ('delete_subgraph', rolled_back(middle.delete_subgraph)),
+    ]
+    if node_model.dag_denormalized:
+        results.append(('rebuild_denormalized', rolled_back(node_model.rebuild_denormalized)))
+    return results
+
+
+def run(node_model, shape, n, only=None, **kwargs):
+    """
+    Loads the shape with n nodes, extra keyword arguments go to the
+    shape function, and returns the measures of the operations, all of
+    them or the ones named in only
+    """
+    using = router.db_for_write(node_model)
+    pairs = SHAPES[shape](n, **kwargs)
+    results = [measure('load %s edges' % len(pairs), lambda: load(node_model, pairs, n), using)]
+    for name, func in operations(node_model, n):
+        if only is None or name in only:
+            results.append(measure(name, func, using))
+    return results
+
+
+def format_results(results):
+    """
+    Returns the measures as a text table
+    """
+    lines = ['%-28s %10s %8s %10s' % ('operation', 'seconds', 'queries', 'peak KiB')]
+    for result in results:
+        peak = '-' if result['peak_kb'] is None else result['peak_kb']
+        lines.append('%-28s %10.4f %8d %10s' % (result['name'], result['seconds'], result['queries'], peak))
+    return '\n'.join(lines)
@@ -0,0 +1,216 @@
+"""
+Traversal cache: primary keys of the descendants, ancestors, roots and
+leaves of every node, invalidated when edges are saved or deleted.
+
+Set the cache on the node model, either in the class body::
+
+    class ConcreteNode(node_factory('ConcreteEdge')):
+        dag_cache = LRUCache()
+
+or later with enable_cache(ConcreteNode).
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+from django.db.models.fields.related import lazy_related_operation
+from django.db.models.signals import post_save, post_delete
+
+
+class LRUCache(object):
+    """
+    In process least recently used cache, the default one.
+
+    Signals only reach the process saving the edges: use DjangoCache with
+    a shared backend when many processes write to the graph.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def clear_prefix(self, prefix):
+        """
+        Removes the keys starting with prefix
+        """
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix + ':')]:
+                del self._data[key]
+
+
+class DjangoCache(object):
+    """
+    Cache stored in one of the CACHES of the Django settings.
+
+    Values are stored with the generation of their prefix, bumped by
+    clear_prefix(): backends can't remove keys by prefix and clearing
+    the whole cache would drop the entries of other applications.
+    """
+
+    def __init__(self, alias='default', timeout=DEFAULT_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _generation_key(self, key):
+        return '%s:generation' % key.rsplit(':', 2)[0]
+
+    def get(self, key):
+        generation_key = self._generation_key(key)
+        values = self.cache.get_many([generation_key, key])
+        stored = values.get(key)
+        if stored is None or stored[0] != values.get(generation_key, 0):
+            return None
+        return stored[1]
+
+    def set(self, key, value):
+        generation = self.cache.get(self._generation_key(key), 0)
+        self.cache.set(key, (generation, value), self.timeout)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+    def clear(self):
+        self.cache.clear()
+
+    def clear_prefix(self, prefix):
+        """
+        Makes the values stored under prefix stale
+        """
+        generation_key = '%s:generation' % prefix
+        try:
+            self.cache.incr(generation_key)
+        except ValueError:
+            self.cache.set(generation_key, 1, None)
+
+
+def cache_prefix(node_model):
+    return 'django_dag:%s' % node_model._meta.label_lower
+
+
+def cache_key(node_model, kind, pk):
+    return '%s:%s:%s' % (cache_prefix(node_model), kind, pk)
+
+
+def invalidate_model(node_model):
+    """
+    Removes all the cached results of node_model, and only them
+    """
+    cache = node_model.dag_cache
+    if cache is None:
+        return
+    cache.clear_prefix(cache_prefix(node_model))
+    # Readers may cache the old graph until the transaction is committed
+    transaction.on_commit(lambda: cache.clear_prefix(cache_prefix(node_model)))
+
+
+def invalidate_edges(node_model, pairs):
+    """
+    Removes the cached results changed by adding or removing the edges in
+    pairs of (parent, child) primary keys: descendants and leaves of the
+    parents and of their ancestors, ancestors and roots of the children
+    and of their descendants.
+    """
+    cache = node_model.dag_cache
+    if cache is None or not pairs:
+        return
+    above = set(parent for parent, child in pairs)
+    above.update(node_model._dag_reachable_pks(above, reverse=True))
+    below = set(child for parent, child in pairs)
+    below.update(node_model._dag_reachable_pks(below))
+    keys = [cache_key(node_model, kind, pk) for pk in above for kind in ('descendants', 'leaves')]
+    keys.extend(cache_key(node_model, kind, pk) for pk in below for kind in ('ancestors', 'roots'))
+    cache.delete_many(keys)
+    # Readers may cache the old graph until the transaction is committed
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+# Edge models whose deleted rows are maintained in bulk by the current
+# thread, see bulk_deletion()
+_bulk = threading.local()
+
+
+@contextmanager
+def bulk_deletion(edge_model):
+    """
+    Deletes of edge_model within the block still send their signals, but
+    the django_dag receivers leave the cache, the closure, the index and
+    the denormalized fields to the caller, which updates them once for
+    all the deleted edges
+    """
+    models = _bulk.__dict__.setdefault('models', [])
+    models.append(edge_model)
+    try:
+        yield
+    finally:
+        models.pop()
+
+
+def in_bulk_deletion(edge_model):
+    return edge_model in getattr(_bulk, 'models', ())
+
+
+def _edge_changed(sender, instance, **kwargs):
+    if in_bulk_deletion(sender):
+        return
+    node_model = sender._meta.get_field('parent').related_model
+    invalidate_edges(node_model, [instance._dag_node_pks()])
+
+
+def connect_signals(node_model):
+    """
+    Invalidates the cache of node_model when its edges change
+    """
+    def bind(node_model, edge_model):
+        uid = 'django_dag_cache_%s' % edge_model._meta.label_lower
+        post_save.connect(_edge_changed, sender=edge_model, dispatch_uid=uid)
+        post_delete.connect(_edge_changed, sender=edge_model, dispatch_uid=uid)
+
+    through = node_model._meta.get_field('children').remote_field.through
+    lazy_related_operation(bind, node_model, through)
+
+
+def enable_cache(node_model, cache=None):
+    """
+    Enables the traversal cache of node_model, an LRUCache by default
+    """
+    node_model.dag_cache = LRUCache() if cache is None else cache
+    connect_signals(node_model)
+    return node_model.dag_cache
+
+
+def disable_cache(node_model):
+    node_model.dag_cache = None
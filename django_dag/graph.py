@@ -0,0 +1,252 @@
+"""
+In memory graph algorithms working on adjacency dicts, mapping every
+node id to the list of its children ids.
+
+All the algorithms are iterative, the depth of the graph is not bound by
+the recursion limit.
+"""
+
+from bisect import bisect_right
+from collections import deque
+
+
+def postorder(children):
+    """
+    Yields the nodes of an adjacency dict, children before their parents
+    """
+    done = set()
+    for root in list(children):
+        if root in done:
+            continue
+        done.add(root)
+        stack = [(root, iter(children.get(root, ())))]
+        while stack:
+            node, pending = stack[-1]
+            for c in pending:
+                if c not in done:
+                    done.add(c)
+                    stack.append((c, iter(children.get(c, ()))))
+                    break
+            else:
+                stack.pop()
+                yield node
+
+
+def reachable_map(children, starts):
+    """
+    Returns a dict mapping every node of starts to the set of the nodes
+    reachable from it. Starts are visited children first and the walks
+    stop at the starts already visited, reusing their results.
+    """
+    starts = set(starts)
+    result = {}
+    for start in postorder(children):
+        if start not in starts:
+            continue
+        reached = set()
+        stack = [start]
+        while stack:
+            for c in children.get(stack.pop(), ()):
+                if c not in reached:
+                    reached.add(c)
+                    if c in result:
+                        reached.update(result[c])
+                    else:
+                        stack.append(c)
+        result[start] = reached
+    return result
+
+
+def topological_sort(children):
+    """
+    Kahn's algorithm, returns the list of nodes sorted parents first and
+    the list of nodes left out because they are in or below a cycle
+    """
+    indegree = {}
+    for node, node_children in children.items():
+        indegree.setdefault(node, 0)
+        for c in node_children:
+            indegree[c] = indegree.get(c, 0) + 1
+    queue = deque(n for n, d in indegree.items() if d == 0)
+    order = []
+    while queue:
+        node = queue.popleft()
+        order.append(node)
+        for c in children.get(node, ()):
+            indegree[c] -= 1
+            if not indegree[c]:
+                queue.append(c)
+    return order, [n for n, d in indegree.items() if d]
+
+
+def depth_map(children, longest=True):
+    """
+    Returns a dict mapping every node of an acyclic adjacency dict to the
+    length of the longest path from a root, or of the shortest one
+    """
+    order, cyclic = topological_sort(children)
+    depths = dict((n, 0) for n in order)
+    pick = max if longest else min
+    reached = set()
+    for node in order:
+        for c in children.get(node, ()):
+            depth = depths[node] + 1
+            depths[c] = pick(depths[c], depth) if c in reached else depth
+            reached.add(c)
+    return depths
+
+
+def strong_components(children):
+    """
+    Tarjan's algorithm, returns a dict mapping every node to a
+    representative node of its strongly connected component
+    """
+    index = {}
+    low = {}
+    components = {}
+    stack = []
+    on_stack = set()
+    for root in list(children):
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(children.get(root, ())))]
+        while work:
+            node, pending = work[-1]
+            for c in pending:
+                if c not in index:
+                    index[c] = low[c] = len(index)
+                    stack.append(c)
+                    on_stack.add(c)
+                    work.append((c, iter(children.get(c, ()))))
+                    break
+                elif c in on_stack:
+                    low[node] = min(low[node], index[c])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        components[member] = node
+                        if member == node:
+                            break
+    return components
+
+
+def cycle_edges(children, edges):
+    """
+    Returns the edges, among the given (parent, child) pairs, which are
+    part of a cycle of the adjacency dict
+    """
+    order, cyclic = topological_sort(children)
+    if not cyclic:
+        return []
+    cyclic = set(cyclic)
+    residue = dict((n, [c for c in children.get(n, ()) if c in cyclic]) for n in cyclic)
+    components = strong_components(residue)
+    return [(p, c) for p, c in edges
+            if p == c or (p in cyclic and c in cyclic and components[p] == components[c])]
+
+
+def chains(links, start):
+    """
+    Yields every list of nodes from start following links, a dict mapping
+    nodes to lists of nodes, up to a node without links. Chains are
+    yielded in the order of the links.
+    """
+    # Chains are linked (node, previous) pairs, copied only when yielded
+    stack = [(start, None)]
+    while stack:
+        chain = stack.pop()
+        following = links[chain[0]]
+        if not following:
+            nodes = []
+            while chain is not None:
+                nodes.append(chain[0])
+                chain = chain[1]
+            yield nodes[::-1]
+            continue
+        for node in reversed(following):
+            stack.append((node, chain))
+
+
+def merge_intervals(intervals):
+    """
+    Returns the sorted disjoint (low, high) intervals covering the same
+    integers as intervals
+    """
+    merged = []
+    for low, high in sorted(intervals):
+        if merged and low <= merged[-1][1] + 1:
+            if high > merged[-1][1]:
+                merged[-1] = (merged[-1][0], high)
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def intervals_contain(intervals, number):
+    """
+    Checks if number is in the sorted disjoint intervals
+    """
+    i = bisect_right(intervals, (number, float('inf'))) - 1
+    return i >= 0 and intervals[i][1] >= number
+
+
+def interval_labels(children):
+    """
+    Returns a dict mapping every node to its label, its postorder number,
+    and the intervals of the labels of the nodes it reaches, itself
+    included. The nodes reached through the depth first spanning tree
+    get consecutive labels, so only the other edges add intervals.
+    """
+    labels = {}
+    for number, node in enumerate(postorder(children), 1):
+        intervals = [(number, number)]
+        for c in children.get(node, ()):
+            if c in labels:
+                intervals.extend(labels[c][1])
+        labels[node] = (number, merge_intervals(intervals))
+    return labels
+
+
+def common_reachable(links, starts):
+    """
+    Breadth first search from all the starts at once following links, a
+    dict mapping nodes to lists of nodes. Returns a dict mapping the
+    nodes reached from every start, starts included, to the tuple of
+    their distances from each start.
+    """
+    count = len(starts)
+    distances = {}
+    frontier = []
+    for i, start in enumerate(starts):
+        distances.setdefault(start, [None] * count)[i] = 0
+        frontier.append((start, i))
+    depth = 0
+    while frontier:
+        depth += 1
+        found = []
+        for node, i in frontier:
+            for n in links.get(node, ()):
+                reached = distances.setdefault(n, [None] * count)
+                if reached[i] is None:
+                    reached[i] = depth
+                    found.append((n, i))
+        frontier = found
+    return dict((n, tuple(d)) for n, d in distances.items() if None not in d)
+
+
+def nearest_common(links, common):
+    """
+    Returns the nodes of common not linked from another node of common:
+    the ones with no other common node between them and the starts
+    """
+    covered = set(n for node in common for n in links.get(node, ()))
+    return [n for n in common if n not in covered]
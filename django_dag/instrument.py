@@ -0,0 +1,132 @@
+"""
+Opt-in instrumentation of the traversal methods.
+
+The public NodeBase methods send traversal_done when they return, only
+if receivers are connected for the node model (or for any sender), with
+the TraversalStats of the call: queries run, edge and closure rows read,
+nodes visited, cache hits and misses and elapsed time. Calls made by an
+instrumented method are counted in its stats and not reported.
+
+Log every traversal::
+
+    traversal_done.connect(log_traversal)
+
+or collect the ones run by a block of code::
+
+    with record_traversals() as calls:
+        node.descendants_set()
+    calls[0].queries
+"""
+
+import functools
+import logging
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.db import connections, router
+from django.dispatch import Signal
+
+logger = logging.getLogger('django_dag')
+
+# Sent with the method name, the node (None for class methods) and stats
+traversal_done = Signal(use_caching=True)
+
+_local = threading.local()
+
+
+class TraversalStats(object):
+    """
+    Counters of one call of an instrumented method
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.thread = threading.current_thread().ident
+        self.queries = 0
+        self.rows = 0
+        self.nodes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return '<TraversalStats %s>' % ' '.join('%s=%s' % item for item in sorted(self.as_dict().items()))
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in (
+            'method', 'queries', 'rows', 'nodes', 'cache_hits', 'cache_misses', 'seconds'))
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+def count_traversal(**counts):
+    """
+    Adds to the counters of the instrumented call running in this thread
+    """
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        for name, value in counts.items():
+            setattr(stats, name, getattr(stats, name) + value)
+
+
+def _counting_queries(stats, aliases, func):
+    if not aliases:
+        return func()
+    with connections[aliases[0]].execute_wrapper(stats.count_query):
+        return _counting_queries(stats, aliases[1:], func)
+
+
+def instrumented(method):
+    """
+    Decorates a NodeBase method, or a class method, to send traversal_done
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        sender = self if isinstance(self, type) else self.__class__
+        if getattr(_local, 'stats', None) is not None or not traversal_done.has_listeners(sender):
+            return method(self, *args, **kwargs)
+        stats = _local.stats = TraversalStats(method.__name__)
+        aliases = sorted(set([router.db_for_read(sender), router.db_for_write(sender)]))
+        start = default_timer()
+        try:
+            return _counting_queries(stats, aliases, lambda: method(self, *args, **kwargs))
+        finally:
+            stats.seconds = default_timer() - start
+            _local.stats = None
+            traversal_done.send(sender=sender, method=method.__name__,
+                                node=None if sender is self else self, stats=stats)
+    return wrapper
+
+
+def log_traversal(sender, method, node, stats, **kwargs):
+    """
+    traversal_done receiver logging the stats on the django_dag logger
+    """
+    logger.debug('%s.%s(%s): %s queries, %s rows, %s nodes, %s/%s cache hits, %.4fs',
+                 sender.__name__, method, '' if node is None else node.pk, stats.queries,
+                 stats.rows, stats.nodes, stats.cache_hits, stats.cache_hits + stats.cache_misses,
+                 stats.seconds)
+
+
+@contextmanager
+def record_traversals(callback=None, sender=None):
+    """
+    Collects the stats of the traversals run by this thread in the block,
+    of the sender node model only if given, in the yielded list. If a
+    callback is given it gets every stats instead.
+    """
+    calls = []
+    thread = threading.current_thread().ident
+
+    def receiver(sender, stats, **kwargs):
+        if stats.thread == thread:
+            (callback or calls.append)(stats)
+
+    traversal_done.connect(receiver, sender=sender, weak=False)
+    try:
+        yield calls
+    finally:
+        traversal_done.disconnect(receiver, sender=sender)
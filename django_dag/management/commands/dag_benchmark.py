@@ -0,0 +1,45 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections, router
+
+from django_dag.benchmark import SHAPES, run, format_results
+
+
+class Command(BaseCommand):
+    help = ('Measures the graph operations on synthetic DAGs, in a throwaway '
+            'test database unless --use-live-db is given')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Node model, as app_label.ModelName')
+        parser.add_argument('--shape', action='append', choices=sorted(SHAPES),
+                            help='Graph shape, can be repeated; all of them by default')
+        parser.add_argument('--size', type=int, action='append',
+                            help='Number of nodes, can be repeated; 1000 by default')
+        parser.add_argument('--edges', type=int, help='Number of edges of the random shape')
+        parser.add_argument('--width', type=int, default=2, help='Layer width of the lattice shape')
+        parser.add_argument('--backend', choices=['closure', 'cte', 'python'],
+                            help='Traversal backend, the default one otherwise')
+        parser.add_argument('--only', action='append', help='Operation to measure, can be repeated')
+        parser.add_argument('--use-live-db', action='store_true',
+                            help='Run in the configured database: ALL the nodes and edges of the model are deleted')
+
+    def handle(self, *args, **options):
+        node_model = apps.get_model(options['model'])
+        connection = connections[router.db_for_write(node_model)]
+        if not options['use_live_db']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        backend = node_model.dag_backend
+        node_model.dag_backend = options['backend'] or backend
+        try:
+            for shape in options['shape'] or sorted(SHAPES):
+                for size in options['size'] or [1000]:
+                    results = run(node_model, shape, size, only=options['only'],
+                                  edges=options['edges'], width=options['width'])
+                    self.stdout.write('%s, %s nodes, %s backend' % (
+                        shape, size, node_model._dag_get_backend()))
+                    self.stdout.write(format_results(results) + '\n')
+        finally:
+            node_model.dag_backend = backend
+            if not options['use_live_db']:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,38 @@
+import sys
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from django_dag.transfer import FORMATS, check_format, export_edges
+
+
+class Command(BaseCommand):
+    help = 'Streams the edges of a node model to newline-delimited JSON, CSV or a binary edge list'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Node model, as app_label.ModelName')
+        parser.add_argument('--output', '-o', default='-', help='Output file, standard output by default')
+        parser.add_argument('--format', choices=FORMATS, default='ndjson')
+        parser.add_argument('--key', default='pk', help='Unique node field identifying the nodes')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        node_model = apps.get_model(options['model'])
+        try:
+            check_format(node_model, options['format'], options['key'])
+        except ValueError as e:
+            raise CommandError(e)
+        binary = options['format'] == 'binary'
+        if options['output'] == '-':
+            stream = sys.stdout.buffer if binary else self.stdout
+            close = False
+        else:
+            stream = open(options['output'], 'wb') if binary else open(options['output'], 'w', newline='')
+            close = True
+        try:
+            count = export_edges(node_model, stream, options['format'], options['key'],
+                                 options['chunk_size'])
+        finally:
+            if close:
+                stream.close()
+        self.stderr.write('%s edges exported' % count)
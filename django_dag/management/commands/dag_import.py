@@ -0,0 +1,40 @@
+import sys
+
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from django_dag.transfer import FORMATS, import_edges
+
+
+class Command(BaseCommand):
+    help = ('Adds the edges of a file written by dag_export to a node model, '
+            'in chunks, then checks the graph for cycles')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Node model, as app_label.ModelName')
+        parser.add_argument('input', help='Input file, - for standard input')
+        parser.add_argument('--format', choices=FORMATS, default='ndjson')
+        parser.add_argument('--key', default='pk', help='Unique node field identifying the nodes')
+        parser.add_argument('--create-missing', action='store_true',
+                            help='Create the unknown nodes with only their key set')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        node_model = apps.get_model(options['model'])
+        binary = options['format'] == 'binary'
+        if options['input'] == '-':
+            stream = sys.stdin.buffer if binary else sys.stdin
+        else:
+            stream = open(options['input'], 'rb') if binary else open(options['input'], newline='')
+        try:
+            count = import_edges(node_model, stream, options['format'], options['key'],
+                                 options['create_missing'], options['chunk_size'])
+        except ValidationError as e:
+            raise CommandError('; '.join(e.messages))
+        except ValueError as e:
+            raise CommandError(e)
+        finally:
+            if options['input'] != '-':
+                stream.close()
+        self.stdout.write('%s edges imported' % count)
@@ -0,0 +1,19 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the reachability index of node models from their edge tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', nargs='+', help='Node model, as app_label.ModelName')
+
+    def handle(self, *args, **options):
+        for name in options['model']:
+            node_model = apps.get_model(name)
+            index = node_model._dag_reachability_model()
+            if index is None:
+                raise CommandError('%s has no reachability index, see reachability_factory' % name)
+            index.rebuild()
+            self.stdout.write('%s: %s nodes labelled, %s intervals' % (
+                name, index.objects.values('node').distinct().count(), index.objects.count()))
@@ -6,9 +6,36 @@ Some ideas stolen from: from https://github.com/stdbrouw/django-treebeard-dag
 
 """
 
-from django.db import models
+import zlib
+from collections import deque
+from itertools import islice
+
+from django.db import models, connections, router, transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+from django.db.models.fields.related import lazy_related_operation
+from django.db.models.signals import class_prepared, post_delete
 from django.core.exceptions import ValidationError
 
+from .cache import bulk_deletion, cache_key, connect_signals, in_bulk_deletion, invalidate_edges
+from .instrument import count_traversal, instrumented
+from .graph import chains, postorder, cycle_edges, depth_map, reachable_map, topological_sort
+from .graph import interval_labels, intervals_contain, merge_intervals, common_reachable, nearest_common
+from .query import SubquerySQL, supports_recursive_cte, closure_sql, reachable_sql, depth_sql
+
+try:
+    from .aio import AsyncNodeMixin
+except (ImportError, SyntaxError):
+    # Python 2 or no asgiref (Django < 3.0): no async methods
+    AsyncNodeMixin = object
+
+
+# Fields added by node_factory(denormalize=True)
+DENORMALIZED_FIELDS = ('child_count', 'parent_count', 'min_depth', 'max_depth')
+
+# Columns of every lookup of the closure rows
+CLOSURE_UNIQUE = ('ancestor', 'descendant', 'depth')
+
 
 class NodeNotReachableException (Exception):
     """
@@ -17,7 +44,159 @@ class NodeNotReachableException (Exception):
     pass
 
 
-class NodeBase(object):
+class DagQuerySet(models.QuerySet):
+    """
+    QuerySet of nodes with graph filters
+    """
+
+    def _edge_ends(self, name):
+        """
+        Returns the lookup on the node field referenced by the edges and
+        the values of the edges at the parent or child end
+        """
+        edge_model = self.model.children.through
+        field = edge_model._meta.get_field(name)
+        return '%s__in' % field.target_field.attname, edge_model.objects.values(field.attname)
+
+    def roots(self):
+        """
+        Nodes with children and without parents
+        """
+        if self.model.dag_denormalized:
+            return self.filter(child_count__gt=0, parent_count=0)
+        parent_lookup, parents = self._edge_ends('parent')
+        child_lookup, children = self._edge_ends('child')
+        return self.filter(**{parent_lookup: parents}).exclude(**{child_lookup: children})
+
+    def leaves(self):
+        """
+        Nodes with parents and without children
+        """
+        if self.model.dag_denormalized:
+            return self.filter(parent_count__gt=0, child_count=0)
+        parent_lookup, parents = self._edge_ends('parent')
+        child_lookup, children = self._edge_ends('child')
+        return self.filter(**{child_lookup: children}).exclude(**{parent_lookup: parents})
+
+    def islands(self):
+        """
+        Nodes without parents and children
+        """
+        if self.model.dag_denormalized:
+            return self.filter(child_count=0, parent_count=0)
+        parent_lookup, parents = self._edge_ends('parent')
+        child_lookup, children = self._edge_ends('child')
+        return self.exclude(**{parent_lookup: parents}).exclude(**{child_lookup: children})
+
+    def descendants_of(self, nodes):
+        """
+        Descendants of a node or of any node of a QuerySet
+        """
+        return self.filter(self.model._dag_reachable_q(nodes))
+
+    def ancestors_of(self, nodes):
+        """
+        Ancestors of a node or of any node of a QuerySet
+        """
+        return self.filter(self.model._dag_reachable_q(nodes, reverse=True))
+
+    def annotate_depth(self, name='depth', longest=True):
+        """
+        Annotates the length of the longest path from a root to every
+        node, or of the shortest one; roots and islands have depth 0
+        """
+        model = self.model
+        backend = model._dag_get_backend()
+        if backend == 'closure':
+            rows = model._dag_closure_model().objects.filter(descendant=models.OuterRef('pk'))
+            if not longest:
+                rows = rows.filter(ancestor___parents__isnull=True)
+            rows = rows.order_by().values('descendant').annotate(
+                depth=(models.Max if longest else models.Min)('depth')).values('depth')
+            depth = Coalesce(models.Subquery(rows, output_field=models.IntegerField()), 0)
+        elif backend == 'cte':
+            connection = model._dag_connection()
+            field = model._dag_edge_fields()[0].target_field
+            column = '%s.%s' % (connection.ops.quote_name(model._meta.db_table),
+                                connection.ops.quote_name(field.column))
+            sql = depth_sql(model.children.through, connection, column, longest)
+            depth = RawSQL(sql, [], output_field=models.IntegerField())
+        else:
+            depths = depth_map(model._dag_graph(self.db), longest)
+            depth = models.Case(*[models.When(pk=pk, then=models.Value(d))
+                                  for pk, d in depths.items() if d],
+                                default=models.Value(0), output_field=models.IntegerField())
+        return self.annotate(**{name: depth})
+
+    def levels(self):
+        """
+        Returns a dict mapping the primary key of every node to its level,
+        the length of the longest path from a root, computed on one fetch
+        of the edge table
+        """
+        return _graph_levels(self.model._dag_graph(self.db), self.values_list('pk', flat=True))
+
+    def topological_order(self, chunk_size=500):
+        """
+        Yields the nodes sorted by level, so parents come before their
+        children, loading them chunk_size at a time
+        """
+        return _iter_in_bulk(self.model, _level_order(self.levels()), chunk_size, self.db)
+
+    def update_levels(self, field=None):
+        """
+        Stores the levels in the field of the nodes, dag_level_field by
+        default, for indexed ordering. Levels change with the edges: run
+        it again after editing the graph.
+        """
+        field = field or self.model.dag_level_field
+        if field is None:
+            raise ValueError('No level field, set dag_level_field on %s' % self.model.__name__)
+        levels = self.levels()
+        by_level = {}
+        for pk, level in levels.items():
+            by_level.setdefault(level, []).append(pk)
+        nodes = self.model._base_manager.using(self.db)
+        size = connections[self.db].features.max_query_params or 500
+        with transaction.atomic(using=self.db):
+            for level, pks in by_level.items():
+                for i in range(0, len(pks), size):
+                    nodes.filter(pk__in=pks[i:i + size]).update(**{field: level})
+        return levels
+
+
+def _graph_levels(children, pks):
+    """
+    Returns a dict mapping every primary key of pks to its level in the
+    adjacency dict children, the length of the longest path from a root
+    """
+    order, cyclic = topological_sort(children)
+    if cyclic:
+        raise ValidationError('The graph has a cycle through %(nodes)s',
+                              code='cycle', params={'nodes': sorted(cyclic)})
+    depths = depth_map(children)
+    return dict((pk, depths.get(pk, 0)) for pk in pks)
+
+
+def _level_order(levels):
+    """
+    Returns the primary keys of levels sorted by level, parents first
+    """
+    return sorted(levels, key=lambda pk: (levels[pk], pk))
+
+
+def _iter_in_bulk(model, pks, chunk_size, using=None):
+    """
+    Yields the nodes of the primary keys, loaded chunk_size at a time
+    from the database using, the routed one by default
+    """
+    for i in range(0, len(pks), chunk_size):
+        instances = model.objects.using(using).in_bulk(pks[i:i + chunk_size])
+        for pk in pks[i:i + chunk_size]:
+            yield instances[pk]
+
+
+class NodeBase(AsyncNodeMixin):
     """
     Main node abstract model
     """
@@ -25,12 +204,42 @@ class NodeBase(object):
     class Meta:
         ordering = ('-id',)
 
+    # Traversal backend: 'closure' reads the transitive closure model
+    # built with closure_factory, 'cte' computes closures with a single
+    # recursive query, 'python' walks the graph with one query per node.
+    # None picks the first one available.
+    dag_backend = None
+
+    # Traversal cache, see django_dag.cache
+    dag_cache = None
+
+    # Optional integer field storing the level of the node, filled by
+    # DagQuerySet.update_levels()
+    dag_level_field = None
+
+    # Locking of Edge.save() against concurrent writers: 'rows' locks the
+    # nodes above and below the new edge with SELECT ... FOR UPDATE,
+    # 'advisory' takes PostgreSQL advisory locks on them instead
+    dag_locking = None
+
+    # Set by node_factory(denormalize=True): the nodes store their
+    # child_count, parent_count, min_depth and max_depth, kept up to date
+    # by the edges
+    dag_denormalized = False
+
+    # Share of the edge table above which the batches of bulk_add_edges()
+    # and of the bulk removals rebuild the closure, the reachability index
+    # and the denormalized fields instead of updating them edge by edge.
+    # None always updates them.
+    dag_rebuild_ratio = 0.1
+
     def __unicode__(self):
         return u"# %s" % self.pk
 
     def __str__(self):
         return self.__unicode__()
 
+    @instrumented
     def add_child(self, descendant, **kwargs):
         """
         Adds a child
@@ -42,23 +251,30 @@ class NodeBase(object):
         return cls.save(disable_circular_check=disable_check)
 
 
+    @instrumented
     def add_parent(self, parent, *args, **kwargs):
         """
         Adds a parent
         """
         return parent.add_child(self, **kwargs)
 
+    @instrumented
     def remove_child(self, descendant):
         """
-        Removes a child
+        Removes a child, raises DoesNotExist if it isn't one
         """
-        self.children.through.objects.get(parent = self, child = descendant).delete()
+        edge_model = self.children.through
+        deleted = edge_model.objects.filter(parent = self, child = descendant).delete()[1]
+        if not deleted.get(edge_model._meta.label):
+            raise edge_model.DoesNotExist('%s is not a child of %s' % (descendant, self))
+        _count_edge(self, descendant, -1)
 
+    @instrumented
     def remove_parent(self, parent):
         """
-        Removes a parent
+        Removes a parent, raises DoesNotExist if it isn't one
         """
-        parent.children.through.objects.get(parent = parent, child = self).delete()
+        parent.remove_child(self)
 
     def parents(self):
         """
@@ -66,194 +282,1202 @@ class NodeBase(object):
         """
         return self.__class__.objects.filter(children = self)
 
-    def descendants_tree(self):
+    @instrumented
+    def descendants_tree(self, max_depth=None, max_nodes=None, flat=False):
         """
-        Returns a tree-like structure with progeny
+        Returns a tree-like structure with progeny, see _tree()
         """
-        tree = {}
-        for f in self.children.all():
-            tree[f] = f.descendants_tree()
-        return tree
+        return self._tree(False, max_depth, max_nodes, flat)
 
-    def ancestors_tree(self):
+    @instrumented
+    def ancestors_tree(self, max_depth=None, max_nodes=None, flat=False):
         """
-        Returns a tree-like structure with ancestors
+        Returns a tree-like structure with ancestors, see _tree()
         """
-        tree = {}
-        for f in self.parents():
-            tree[f] = f.ancestors_tree()
-        return tree
+        return self._tree(True, max_depth, max_nodes, flat)
 
-    def descendants_set(self, cached_results=None):
+    @classmethod
+    def _dag_subgraph(cls, nodes, reverse=False, max_depth=None):
         """
-        Returns a set of descendants
+        Returns the adjacency dict, by primary keys, of the nodes reachable
+        from a node or a list of primary keys, within max_depth hops
         """
-        if cached_results is None:
-            cached_results = dict()
-        if self in cached_results.keys():
-            return cached_results[self]
+        pks = [nodes.pk] if isinstance(nodes, models.Model) else list(nodes)
+        adjacency = dict((pk, []) for pk in pks)
+        if max_depth is None and cls._dag_get_backend() != 'python':
+            # All the edges leaving the nodes or their descendants at once
+            source, target = ('child__pk', 'parent__pk') if reverse else ('parent__pk', 'child__pk')
+            reached = cls.objects.filter(cls._dag_reachable_q(nodes, reverse)).values('pk')
+            edges = cls.children.through.objects.filter(
+                models.Q(**{'%s__in' % source: pks}) | models.Q(**{'%s__in' % source: reached}))
+            rows = 0
+            for node, neighbour in edges.values_list(source, target):
+                adjacency.setdefault(node, []).append(neighbour)
+                adjacency.setdefault(neighbour, [])
+                rows += 1
+            count_traversal(rows=rows, nodes=len(adjacency))
+            return adjacency
+        frontier = pks
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            found = []
+            for node, neighbour in cls._dag_adjacency(frontier, reverse=reverse):
+                adjacency[node].append(neighbour)
+                if neighbour not in adjacency:
+                    adjacency[neighbour] = []
+                    found.append(neighbour)
+            frontier = found
+        return adjacency
+
+    def _tree(self, reverse=False, max_depth=None, max_nodes=None, flat=False):
+        """
+        Returns nested dicts of descendants, or ancestors if reverse,
+        loading the edges and the nodes once.
+
+        Nodes reachable through many paths share the same dict, up to
+        max_depth levels and max_nodes nodes, picked breadth first, are
+        included. With flat, returns instead a dict mapping every node,
+        self included, to the list of its children (parents).
+        """
+        adjacency = self._dag_subgraph(self, reverse, max_depth)
+        depths = {self.pk: 0}
+        queue = deque([self.pk])
+        while queue and (max_nodes is None or len(depths) <= max_nodes):
+            node = queue.popleft()
+            if max_depth is not None and depths[node] >= max_depth:
+                continue
+            for neighbour in adjacency[node]:
+                if neighbour not in depths:
+                    if max_nodes is not None and len(depths) > max_nodes:
+                        break
+                    depths[neighbour] = depths[node] + 1
+                    queue.append(neighbour)
+        instances = self.__class__.objects.in_bulk([pk for pk in depths if pk != self.pk])
+        instances[self.pk] = self
+
+        def links(node, remaining):
+            if remaining == 0:
+                return []
+            return [n for n in adjacency[node] if n in depths]
+
+        if flat:
+            flat_tree = {}
+            for node, depth in depths.items():
+                remaining = None if max_depth is None else max_depth - depth
+                flat_tree[instances[node]] = [instances[n] for n in links(node, remaining)]
+            return flat_tree
+        # Subtrees are shared by the paths reaching a node with the same
+        # remaining depth
+        trees = {}
+        stack = [(self.pk, max_depth, False)]
+        while stack:
+            node, remaining, expanded = stack.pop()
+            if (node, remaining) in trees:
+                continue
+            below = None if remaining is None else remaining - 1
+            if expanded:
+                trees[(node, remaining)] = dict((instances[n], trees[(n, below)])
+                                                for n in links(node, remaining))
+            else:
+                stack.append((node, remaining, True))
+                stack.extend((n, below, False) for n in links(node, remaining))
+        return trees[(self.pk, max_depth)]
+
+    @classmethod
+    def _dag_edge_fields(cls):
+        """
+        Returns the parent and child fields of the edge model
+        """
+        opts = cls.children.through._meta
+        return opts.get_field('parent'), opts.get_field('child')
+
+    @classmethod
+    def _dag_connection(cls):
+        return connections[router.db_for_read(cls)]
+
+    @classmethod
+    def _dag_closure_model(cls):
+        """
+        Returns the transitive closure model of this node, if any
+        """
+        for rel in cls._meta.related_objects:
+            if getattr(rel.related_model, 'dag_closure', False) and rel.field.name == 'ancestor':
+                return rel.related_model
+        return None
+
+    @classmethod
+    def _dag_reachability_model(cls):
+        """
+        Returns the reachability index model of this node, if any
+        """
+        for rel in cls._meta.related_objects:
+            if getattr(rel.related_model, 'dag_reachability', False) and rel.field.name == 'node':
+                return rel.related_model
+        return None
+
+    @classmethod
+    def _dag_get_backend(cls):
+        """
+        Returns the traversal backend in use
+        """
+        backend = cls.dag_backend
+        if backend in (None, 'closure') and cls._dag_closure_model() is not None:
+            return 'closure'
+        if backend in (None, 'cte') and cls._dag_cte_enabled():
+            return 'cte'
+        return 'python'
+
+    @classmethod
+    def _dag_cte_enabled(cls):
+        """
+        Checks if recursive queries can be run on the edge table
+        """
+        if cls.dag_backend == 'python':
+            return False
+        parent, child = cls._dag_edge_fields()
+        # Edges must reference the same node field on both ends
+        if parent.target_field.attname != child.target_field.attname:
+            return False
+        return cls.dag_backend == 'cte' or supports_recursive_cte(cls._dag_connection())
+
+    @classmethod
+    def _dag_adjacency(cls, pks, reverse=False):
+        """
+        Returns the (node, child) primary keys of the edges leaving the
+        given nodes, or the (node, parent) ones reaching them if reverse
+        """
+        source, target = ('child__pk', 'parent__pk') if reverse else ('parent__pk', 'child__pk')
+        edges = cls.children.through.objects
+        pks = list(pks)
+        size = cls._dag_connection().features.max_query_params or len(pks) or 1
+        adjacency = []
+        for i in range(0, len(pks), size):
+            adjacency.extend(edges.filter(**{'%s__in' % source: pks[i:i + size]}).values_list(source, target))
+        count_traversal(rows=len(adjacency), nodes=len(pks))
+        return adjacency
+
+    @classmethod
+    def _dag_reachable_pks(cls, pks, reverse=False):
+        """
+        Returns the primary keys of the descendants of the given nodes,
+        or of their ancestors if reverse is True
+        """
+        pks = list(pks)
+        size = cls._dag_connection().features.max_query_params or len(pks) or 1
+        if len(pks) > size:
+            reached = set()
+            for i in range(0, len(pks), size):
+                reached.update(cls._dag_reachable_pks(pks[i:i + size], reverse))
+            return reached
+        if not pks:
+            return set()
+        backend = cls._dag_get_backend()
+        if backend == 'closure':
+            source, target = ('descendant', 'ancestor') if reverse else ('ancestor', 'descendant')
+            rows = cls._dag_closure_model().objects.filter(**{'%s__in' % source: pks})
+            reached = set(rows.values_list(target, flat=True))
+            count_traversal(rows=len(reached), nodes=len(reached))
+            return reached
+        if backend == 'cte':
+            to_field = cls._dag_edge_fields()[0].target_field.attname
+            if to_field != cls._meta.pk.attname:
+                pks = list(cls.objects.filter(pk__in=pks).values_list(to_field, flat=True))
+            sql, params = closure_sql(cls.children.through, cls._dag_connection(), pks, reverse=reverse)
+            nodes = cls.objects.filter(**{'%s__in' % to_field: SubquerySQL(sql, params)})
+            reached = set(nodes.values_list('pk', flat=True))
+            count_traversal(rows=len(reached), nodes=len(reached))
+            return reached
+        reached = set()
+        frontier = pks
+        while frontier:
+            frontier = set(n for pk, n in cls._dag_adjacency(frontier, reverse=reverse)) - reached
+            reached.update(frontier)
+        return reached
+
+    @classmethod
+    def _dag_reachable_q(cls, nodes, reverse=False):
+        """
+        Returns a Q object matching the descendants, or the ancestors if
+        reverse is True, of a node, of any node of a QuerySet or of a list
+        of primary keys
+        """
+        if isinstance(nodes, models.QuerySet):
+            start = lambda field: nodes.order_by().values(field)
+        elif isinstance(nodes, models.Model):
+            start = lambda field: [getattr(nodes, field)]
         else:
-            res = set()
-            for f in self.children.all():
-                res.add(f)
-                res.update(f.descendants_set(cached_results=cached_results))
-            cached_results[self] = res
-            return res
+            pks = list(nodes)
+            start = lambda field: (pks if field == cls._meta.pk.attname
+                                   else cls.objects.filter(pk__in=pks).values(field))
+        backend = cls._dag_get_backend()
+        if backend == 'closure':
+            source, target = ('descendant', 'ancestor') if reverse else ('ancestor', 'descendant')
+            rows = cls._dag_closure_model().objects.filter(**{'%s__in' % source: start(cls._meta.pk.attname)})
+            return models.Q(pk__in=rows.values(target))
+        if backend == 'cte':
+            to_field = cls._dag_edge_fields()[0].target_field.attname
+            sql, params = closure_sql(cls.children.through, cls._dag_connection(),
+                                      start(to_field), reverse=reverse)
+            return models.Q(**{'%s__in' % to_field: SubquerySQL(sql, params)})
+        if isinstance(nodes, models.QuerySet):
+            pks = nodes.values_list('pk', flat=True)
+        elif isinstance(nodes, models.Model):
+            pks = [nodes.pk]
+        return models.Q(pk__in=list(cls._dag_reachable_pks(pks, reverse)))
 
-    def ancestors_set(self, cached_results=None):
+    @classmethod
+    @instrumented
+    def descendants_map(cls, nodes):
         """
-        Returns a set of ancestors
+        Returns a dict mapping the primary key of every node, in a list of
+        nodes or primary keys or in a QuerySet, to the set of primary keys
+        of its descendants. The edges below all the nodes are fetched once.
         """
-        if cached_results is None:
-            cached_results = dict()
-        if self in cached_results.keys():
-            return cached_results[self]
+        return cls._dag_reachable_map(nodes)
+
+    @classmethod
+    @instrumented
+    def ancestors_map(cls, nodes):
+        """
+        Returns a dict mapping the primary key of every node to the set
+        of primary keys of its ancestors, see descendants_map()
+        """
+        return cls._dag_reachable_map(nodes, reverse=True)
+
+    @classmethod
+    def _dag_reachable_map(cls, nodes, reverse=False):
+        if isinstance(nodes, models.QuerySet):
+            pks = list(nodes.values_list('pk', flat=True))
         else:
-            res = set()
-            for f in self.parents():
-                res.add(f)
-                res.update(f.ancestors_set(cached_results=cached_results))
-            cached_results[self] = res
-            return res
+            pks = [getattr(n, 'pk', n) for n in nodes]
+        kind = 'ancestors' if reverse else 'descendants'
+        cache = cls.dag_cache
+        result = {}
+        if cache is not None:
+            for pk in pks:
+                cached = cache.get(cache_key(cls, kind, pk))
+                if cached is not None:
+                    result[pk] = set(cached)
+            count_traversal(cache_hits=len(result), cache_misses=len(pks) - len(result))
+        missing = [pk for pk in pks if pk not in result]
+        if not missing:
+            return result
+        if cls._dag_get_backend() == 'closure':
+            source, target = ('descendant', 'ancestor') if reverse else ('ancestor', 'descendant')
+            computed = dict((pk, set()) for pk in missing)
+            rows = cls._dag_closure_model().objects.filter(**{'%s__in' % source: missing})
+            for pk, reached in rows.values_list(source, target):
+                computed[pk].add(reached)
+                count_traversal(rows=1)
+        else:
+            computed = reachable_map(cls._dag_subgraph(missing, reverse), missing)
+        if cache is not None:
+            for pk, reached in computed.items():
+                cache.set(cache_key(cls, kind, pk), frozenset(reached))
+        result.update(computed)
+        return result
+
+    @classmethod
+    def _dag_graph(cls, using=None):
+        """
+        Returns the adjacency dict, by primary keys, of the whole graph in
+        the database using, the routed one by default
+        """
+        children = {}
+        for parent, child in _edge_pk_pairs(cls.children.through, using):
+            children.setdefault(parent, []).append(child)
+            children.setdefault(child, [])
+        return children
+
+    def _dag_cached(self, kind, compute):
+        """
+        Returns the set of nodes computed by compute, the primary keys are
+        stored in the traversal cache, when enabled, under kind
+        """
+        cache = self.dag_cache
+        if cache is None:
+            return set(compute())
+        key = cache_key(self.__class__, kind, self.pk)
+        pks = cache.get(key)
+        count_traversal(cache_hits=pks is not None, cache_misses=pks is None)
+        if pks is None:
+            nodes = set(compute())
+            cache.set(key, frozenset(n.pk for n in nodes))
+            return nodes
+        return set(self.__class__.objects.in_bulk(list(pks)).values())
+
+    def _reachable(self, reverse=False):
+        """
+        Returns a QuerySet of descendants, or ancestors if reverse is True
+        """
+        cls = self.__class__
+        return cls.objects.filter(cls._dag_reachable_q(self, reverse))
+
+    @instrumented
+    def descendants(self):
+        """
+        Returns a lazy QuerySet of descendants
+        """
+        return self._reachable()
+
+    @instrumented
+    def ancestors(self):
+        """
+        Returns a lazy QuerySet of ancestors
+        """
+        return self._reachable(reverse=True)
+
+    @instrumented
+    def is_ancestor_of(self, other):
+        """
+        Checks if other is a descendant, with a single query on the
+        closure and cte backends
+        """
+        cls = self.__class__
+        if cls.dag_cache is not None:
+            descendants = cls.dag_cache.get(cache_key(cls, 'descendants', self.pk))
+            count_traversal(cache_hits=descendants is not None, cache_misses=descendants is None)
+            if descendants is not None:
+                return other.pk in descendants
+        index = cls._dag_reachability_model()
+        if index is not None:
+            return index.reaches(self.pk, other.pk)
+        backend = cls._dag_get_backend()
+        if backend == 'closure':
+            closure = cls._dag_closure_model()
+            return closure.objects.filter(ancestor=self, descendant=other).exists()
+        if backend == 'cte':
+            to_field = cls._dag_edge_fields()[0].target_field.attname
+            connection = cls._dag_connection()
+            sql, params = reachable_sql(cls.children.through, connection,
+                                        getattr(self, to_field), getattr(other, to_field))
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.fetchone() is not None
+        # One query per level, stopping at the level holding other
+        seen = set([self.pk])
+        frontier = seen
+        while frontier:
+            children = set(child for parent, child in cls._dag_adjacency(frontier))
+            if other.pk in children:
+                return True
+            frontier = children - seen
+            seen.update(frontier)
+        return False
+
+    @instrumented
+    def is_descendant_of(self, other):
+        """
+        Checks if other is an ancestor
+        """
+        return other.is_ancestor_of(self)
+
+    def _dag_cached_pks(self, kind):
+        """
+        Returns the frozenset of primary keys of the descendants, or of the
+        ancestors, as kind, without loading any node
+        """
+        cache = self.dag_cache
+        key = cache_key(self.__class__, kind, self.pk)
+        pks = None if cache is None else cache.get(key)
+        if cache is not None:
+            count_traversal(cache_hits=pks is not None, cache_misses=pks is None)
+        if pks is None:
+            pks = frozenset(self._dag_reachable_pks([self.pk], reverse=kind == 'ancestors'))
+            if cache is not None:
+                cache.set(key, pks)
+        return pks
+
+    def _dag_edge_pks(self, reverse=False):
+        """
+        Returns the frozenset of (parent, child) primary keys of the edges
+        below self, or above it if reverse
+        """
+        adjacency = self._dag_subgraph(self, reverse)
+        if reverse:
+            return frozenset((n, node) for node, linked in adjacency.items() for n in linked)
+        return frozenset((node, n) for node, linked in adjacency.items() for n in linked)
+
+    def _load_edges(self, pairs):
+        """
+        Converts (parent, child) primary keys to nodes, in one query
+        """
+        nodes = self.__class__.objects.in_bulk(set(pk for pair in pairs for pk in pair) - set([self.pk]))
+        nodes[self.pk] = self
+        return set((nodes[parent], nodes[child]) for parent, child in pairs)
+
+    def _dag_load(self, nodes):
+        """
+        Loads a QuerySet of reached nodes. On the closure and cte backends
+        the walk runs in the database: the nodes are counted as read here.
+        """
+        nodes = list(nodes)
+        if self._dag_get_backend() != 'python':
+            count_traversal(rows=len(nodes), nodes=len(nodes))
+        return nodes
 
-    def descendants_edges_set(self, cached_results=None):
+    def _dag_reachable_set(self, reverse=False):
         """
-        Returns a set of descendants edges
+        Returns the set of descendants, or of ancestors if reverse
         """
+        cls = self.__class__
+        if cls._dag_get_backend() != 'python':
+            return set(self._dag_load(self._reachable(reverse)))
+        # One query per level, then the nodes in batches
+        pks = list(cls._dag_reachable_pks([self.pk], reverse))
+        return set(cls.objects.in_bulk(pks).values())
+
+    @instrumented
+    def descendants_set(self, cached_results=None, ids_only=False):
+        """
+        Returns a set of descendants, or a frozenset of their primary keys
+        if ids_only. The cached_results dict, kept for compatibility,
+        maps nodes to their known descendants.
+        """
+        if ids_only:
+            return self._dag_cached_pks('descendants')
         if cached_results is None:
-            cached_results = dict()
-        if self in cached_results.keys():
-            return cached_results[self]
-        else:
-            res = set()
-            for f in self.children.all():
-                res.add((self, f))
-                res.update(f.descendants_edges_set(cached_results=cached_results))
-            cached_results[self] = res
-            return res
+            return self._dag_cached('descendants', self._dag_reachable_set)
+        if self not in cached_results:
+            cached_results[self] = self._dag_reachable_set()
+        return cached_results[self]
 
-    def ancestors_edges_set(self, cached_results=None):
+    @instrumented
+    def ancestors_set(self, cached_results=None, ids_only=False):
         """
-        Returns a set of ancestors edges
+        Returns a set of ancestors, or a frozenset of their primary keys
+        if ids_only, see descendants_set()
         """
+        if ids_only:
+            return self._dag_cached_pks('ancestors')
         if cached_results is None:
-            cached_results = dict()
-        if self in cached_results.keys():
-            return cached_results[self]
-        else:
-            res = set()
-            for f in self.parents():
-                res.add((f, self))
-                res.update(f.ancestors_edges_set(cached_results=cached_results))
-            cached_results[self] = res
-            return res
+            return self._dag_cached('ancestors', lambda: self._dag_reachable_set(reverse=True))
+        if self not in cached_results:
+            cached_results[self] = self._dag_reachable_set(reverse=True)
+        return cached_results[self]
+
+    @instrumented
+    def descendants_edges_set(self, cached_results=None, ids_only=False):
+        """
+        Returns a set of descendants edges, as (parent, child) nodes or
+        as a frozenset of primary keys pairs if ids_only
+        """
+        if ids_only:
+            return self._dag_edge_pks()
+        if cached_results is None:
+            return self._load_edges(self._dag_edge_pks())
+        if self not in cached_results:
+            cached_results[self] = self._load_edges(self._dag_edge_pks())
+        return cached_results[self]
+
+    @instrumented
+    def ancestors_edges_set(self, cached_results=None, ids_only=False):
+        """
+        Returns a set of ancestors edges, as (parent, child) nodes or as
+        a frozenset of primary keys pairs if ids_only
+        """
+        if ids_only:
+            return self._dag_edge_pks(reverse=True)
+        if cached_results is None:
+            return self._load_edges(self._dag_edge_pks(reverse=True))
+        if self not in cached_results:
+            cached_results[self] = self._load_edges(self._dag_edge_pks(reverse=True))
+        return cached_results[self]
 
-    def nodes_set(self):
+    @instrumented
+    def nodes_set(self, ids_only=False):
         """
         Retrun a set of all nodes
         """
+        if ids_only:
+            return (frozenset([self.pk]) | self.ancestors_set(ids_only=True) |
+                    self.descendants_set(ids_only=True))
         nodes = set()
         nodes.add(self)
         nodes.update(self.ancestors_set())
         nodes.update(self.descendants_set())
         return nodes
 
-    def edges_set(self):
+    @instrumented
+    def edges_set(self, ids_only=False):
         """
         Returns a set of all edges
         """
+        if ids_only:
+            return self.descendants_edges_set(ids_only=True) | self.ancestors_edges_set(ids_only=True)
         edges = set()
         edges.update(self.descendants_edges_set())
         edges.update(self.ancestors_edges_set())
         return edges
 
-    def distance(self, target):
+    def _dag_walk(self, reverse=False, order='bfs', chunk_size=500):
+        """
+        Returns an iterator of (node, neighbour, depth, first) primary keys
+        for every edge below self, or above it if reverse, in breadth
+        ('bfs') or depth ('dfs') first order: depth is the one of
+        neighbour in the walk and first tells if neighbour is reached for
+        the first time.
+
+        The edges of up to chunk_size nodes are fetched at once.
+        """
+        if order == 'bfs':
+            return self._dag_bfs(reverse, chunk_size)
+        if order == 'dfs':
+            return self._dag_dfs(reverse, chunk_size)
+        raise ValueError("order must be 'bfs' or 'dfs', not %r" % (order,))
+
+    def _dag_bfs(self, reverse, chunk_size):
+        cls = self.__class__
+        seen = set([self.pk])
+        frontier = [self.pk]
+        depth = 0
+        while frontier:
+            depth += 1
+            found = []
+            for i in range(0, len(frontier), chunk_size):
+                for node, neighbour in cls._dag_adjacency(frontier[i:i + chunk_size], reverse):
+                    first = neighbour not in seen
+                    if first:
+                        seen.add(neighbour)
+                        found.append(neighbour)
+                    yield node, neighbour, depth, first
+            frontier = found
+
+    def _dag_dfs(self, reverse, chunk_size):
+        cls = self.__class__
+        seen = set([self.pk])
+        links = {}
+        stack = [(None, self.pk, 0)]
+        while stack:
+            node, neighbour, depth = stack.pop()
+            if node is not None:
+                first = neighbour not in seen
+                yield node, neighbour, depth, first
+                if not first:
+                    links.pop(neighbour, None)
+                    continue
+                seen.add(neighbour)
+            if neighbour not in links:
+                # Prefetch the edges of the nodes next on the stack
+                pending = (n for p, n, d in reversed(stack) if n not in seen and n not in links)
+                batch = [neighbour] + list(islice(pending, chunk_size - 1))
+                for pk in batch:
+                    links[pk] = []
+                for pk, n in cls._dag_adjacency(batch, reverse):
+                    links[pk].append(n)
+            stack.extend((neighbour, n, depth + 1) for n in reversed(links.pop(neighbour)))
+
+    def _dag_load_rows(self, rows, columns, chunk_size):
+        """
+        Yields the tuples of rows with the primary keys at the columns
+        indexes replaced by nodes, loaded chunk_size rows at a time
+        """
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, chunk_size))
+            if not batch:
+                return
+            pks = set(row[i] for row in batch for i in columns)
+            pks.discard(self.pk)
+            instances = self.__class__.objects.in_bulk(list(pks))
+            instances[self.pk] = self
+            for row in batch:
+                yield tuple(instances[v] if i in columns else v for i, v in enumerate(row))
+
+    def _iter_nodes(self, reverse, order, with_depth, chunk_size):
+        walk = ((n, depth) for node, n, depth, first in self._dag_walk(reverse, order, chunk_size) if first)
+        rows = self._dag_load_rows(walk, (0,), chunk_size)
+        return rows if with_depth else (node for node, depth in rows)
+
+    def iter_descendants(self, order='bfs', with_depth=False, chunk_size=500):
+        """
+        Yields the descendants, breadth first ('bfs') or depth first
+        ('dfs'), as (node, depth) pairs if with_depth. Edges and nodes are
+        fetched chunk_size at a time while iterating.
+        """
+        return self._iter_nodes(False, order, with_depth, chunk_size)
+
+    def iter_ancestors(self, order='bfs', with_depth=False, chunk_size=500):
+        """
+        Yields the ancestors, see iter_descendants()
+        """
+        return self._iter_nodes(True, order, with_depth, chunk_size)
+
+    def iter_edges(self, ancestors=False, order='bfs', ids_only=False, chunk_size=500):
+        """
+        Yields the (parent, child) edges below self, or above it if
+        ancestors, in the order of iter_descendants(). The pairs are
+        primary keys if ids_only.
+        """
+        walk = self._dag_walk(ancestors, order, chunk_size)
+        if ancestors:
+            pairs = ((n, node) for node, n, depth, first in walk)
+        else:
+            pairs = ((node, n) for node, n, depth, first in walk)
+        if ids_only:
+            return pairs
+        return self._dag_load_rows(pairs, (0, 1), chunk_size)
+
+    def _dag_linked_graph(self):
+        """
+        Returns the adjacency dict, by primary keys, of the ancestors, the
+        descendants and self
+        """
+        children = self._dag_subgraph(self)
+        for node, parents in self._dag_subgraph(self, reverse=True).items():
+            children.setdefault(node, [])
+            for parent in parents:
+                children.setdefault(parent, []).append(node)
+        return children
+
+    @instrumented
+    def levels(self):
+        """
+        Returns a dict mapping the primary keys of the ancestors, the
+        descendants and self to their level in this subgraph
+        """
+        children = self._dag_linked_graph()
+        return _graph_levels(children, children)
+
+    def topological_order(self, chunk_size=500):
+        """
+        Yields the ancestors, self and the descendants sorted by level,
+        parents first, loading them chunk_size at a time
+        """
+        return _iter_in_bulk(self.__class__, _level_order(self.levels()), chunk_size)
+
+    def _dag_path_links(self, target):
+        """
+        Returns a function listing the (node, neighbour) edges leaving a
+        frontier, see _dag_adjacency(). On the closure and cte backends
+        the edges on the paths from self to target are fetched at once
+        and the search runs in memory, otherwise there is one query per
+        call.
+        """
+        cls = self.__class__
+        if cls._dag_get_backend() == 'python':
+            return cls._dag_adjacency
+        below = cls.objects.filter(models.Q(pk=self.pk) | cls._dag_reachable_q(self))
+        above = cls.objects.filter(models.Q(pk=target.pk) | cls._dag_reachable_q(target, reverse=True))
+        edges = cls.children.through.objects.filter(parent__in=below, child__in=above)
+        children = {}
+        parents = {}
+        for parent, child in edges.values_list('parent__pk', 'child__pk'):
+            children.setdefault(parent, []).append(child)
+            parents.setdefault(child, []).append(parent)
+        count_traversal(rows=sum(len(c) for c in children.values()), nodes=len(parents) + 1)
+
+        def links(frontier, reverse=False):
+            adjacency = parents if reverse else children
+            return [(node, n) for node in frontier for n in adjacency.get(node, ())]
+        return links
+
+    def _shortest_path_search(self, target, max_depth=None, bidirectional=True):
+        """
+        Breadth first search from self to target, level by level (one
+        query per level on the python backend). A bidirectional search
+        expands the smaller frontier, from self following the children
+        or from target following the parents.
+
+        Returns the predecessors of the nodes reached from self, the
+        successors of the nodes reached from target and the nodes where
+        the searches met: every shortest path goes through one of them.
+        """
+        index = self._dag_reachability_model()
+        if index is not None and not index.reaches(self.pk, target.pk):
+            raise NodeNotReachableException
+        fetch = self._dag_path_links(target)
+        preds = {self.pk: []}
+        succs = {target.pk: []}
+        forward = [self.pk]
+        backward = [target.pk]
+        depth = 0
+        while forward and backward and (max_depth is None or depth < max_depth):
+            depth += 1
+            reverse = bidirectional and len(backward) < len(forward)
+            if reverse:
+                frontier, reached, other = backward, succs, preds
+            else:
+                frontier, reached, other = forward, preds, succs
+            found = {}
+            for node, neighbour in fetch(frontier, reverse):
+                if neighbour not in reached:
+                    found.setdefault(neighbour, []).append(node)
+            # Ties are broken following NodeBase.Meta.ordering
+            for links in found.values():
+                links.sort(reverse=True)
+            reached.update(found)
+            meeting = sorted((n for n in found if n in other), reverse=True)
+            if meeting:
+                return preds, succs, meeting
+            if reverse:
+                backward = list(found)
+            else:
+                forward = list(found)
+        raise NodeNotReachableException
+
+    def _shortest_paths(self, target, max_depth=None, bidirectional=True, first=False):
+        """
+        Yields the shortest paths to target as lists of primary keys
+        """
+        preds, succs, meeting = self._shortest_path_search(target, max_depth, bidirectional)
+        for node in meeting:
+            for head in chains(preds, node):
+                head = head[-2::-1]
+                for tail in chains(succs, node):
+                    yield head + tail[1:]
+                    if first:
+                        return
+
+    def _load_paths(self, paths):
+        """
+        Converts paths of primary keys to paths of nodes, in one query
+        """
+        nodes = self.__class__.objects.in_bulk(set(pk for path in paths for pk in path))
+        return [[nodes[pk] for pk in path] for path in paths]
+
+    @instrumented
+    def distance(self, target, max_depth=None, bidirectional=True):
         """
         Returns the shortest hops count to the target vertex
         """
-        return len(self.path(target))
+        if self == target:
+            return 0
+        if self._dag_get_backend() == 'closure':
+            closure = self._dag_closure_model()
+            depth = closure.objects.filter(ancestor=self, descendant=target).aggregate(
+                models.Min('depth'))['depth__min']
+            if depth is None or (max_depth is not None and depth > max_depth):
+                raise NodeNotReachableException
+            return depth
+        return len(next(self._shortest_paths(target, max_depth, bidirectional, first=True)))
 
-    def path(self, target):
+    @instrumented
+    def path(self, target, max_depth=None, bidirectional=True):
         """
-        Returns the shortest path
+        Returns the shortest path, raises NodeNotReachableException if
+        target is not a descendant within max_depth hops
         """
         if self == target:
             return []
-        if target in self.children.all():
-            return [target]
-        if target in self.descendants_set():
-            path = None
-            for d in self.children.all():
-                try:
-                    desc_path = d.path(target)
-                    if not path or len(desc_path) < len(path):
-                        path = [d] + desc_path
-                except NodeNotReachableException:
-                    pass
-        else:
-            raise NodeNotReachableException
-        return path
+        return self._load_paths(list(self._shortest_paths(
+            target, max_depth, bidirectional, first=True)))[0]
+
+    @instrumented
+    def all_shortest_paths(self, target, max_depth=None, bidirectional=True):
+        """
+        Returns all the shortest paths
+        """
+        if self == target:
+            return [[]]
+        return self._load_paths(list(self._shortest_paths(target, max_depth, bidirectional)))
+
+    def _dag_common(self, nodes, reverse, nearest):
+        """
+        Returns the nodes reached from self and from all the nodes,
+        following the parents if reverse, ranked by their farthest then
+        total distance. The subgraph is fetched once, see _dag_subgraph().
+        """
+        cls = self.__class__
+        pks = [self.pk] + [getattr(n, 'pk', n) for n in nodes]
+        links = cls._dag_subgraph(pks, reverse)
+        common = common_reachable(links, pks)
+        found = nearest_common(links, common) if nearest else list(common)
+        # Ties are broken following NodeBase.Meta.ordering
+        found.sort(reverse=True)
+        found.sort(key=lambda pk: (max(common[pk]), sum(common[pk])))
+        instances = cls.objects.in_bulk([pk for pk in found if pk != self.pk])
+        instances[self.pk] = self
+        return [instances[pk] for pk in found]
+
+    @instrumented
+    def common_ancestors(self, *nodes):
+        """
+        Returns the ancestors shared by self and the nodes, given as nodes
+        or primary keys, the nearest first. A node counts as its own
+        ancestor: if self is an ancestor of the nodes it comes first.
+        """
+        return self._dag_common(nodes, True, False)
+
+    @instrumented
+    def lowest_common_ancestors(self, *nodes):
+        """
+        Returns the common ancestors with no descendant among them, the
+        nearest first, see common_ancestors()
+        """
+        return self._dag_common(nodes, True, True)
+
+    @instrumented
+    def common_descendants(self, *nodes):
+        """
+        Returns the descendants shared by self and the nodes, the nearest
+        first, see common_ancestors()
+        """
+        return self._dag_common(nodes, False, False)
 
+    @instrumented
+    def highest_common_descendants(self, *nodes):
+        """
+        Returns the common descendants with no ancestor among them, the
+        nearest first, see common_ancestors()
+        """
+        return self._dag_common(nodes, False, True)
+
+    @instrumented
     def is_root(self):
         """
         Check if has children and not ancestors
         """
+        if self.dag_denormalized:
+            return bool(self.child_count and not self.parent_count)
         return bool(self.children.exists() and not self._parents.exists())
 
+    @instrumented
     def is_leaf(self):
         """
         Check if has ancestors and not children
         """
+        if self.dag_denormalized:
+            return bool(self.parent_count and not self.child_count)
         return bool(self._parents.exists() and not self.children.exists())
 
+    @instrumented
     def is_island(self):
         """
         Check if has no ancestors nor children
         """
+        if self.dag_denormalized:
+            return not self.child_count and not self.parent_count
         return bool(not self.children.exists() and not self._parents.exists())
 
-    def _get_roots(self, at):
+    @instrumented
+    def get_roots(self):
         """
-        Works on objects: no queries
+        Returns roots nodes, if any
         """
-        if not at:
-          return set([self])
-        roots = set()
-        for a2 in at:
-            roots.update(a2._get_roots(at[a2]))
-        return roots
+        return self._dag_cached('roots', lambda: self._dag_load(
+            self.ancestors().filter(_parents__isnull=True)))
 
-    def get_roots(self):
+    @instrumented
+    def get_leaves(self):
         """
-        Returns roots nodes, if any
+        Returns leaves nodes, if any
         """
-        at =  self.ancestors_tree()
-        roots = set()
-        for a in at:
-            roots.update(a._get_roots(at[a]))
-        return roots
+        return self._dag_cached('leaves', lambda: self._dag_load(
+            self.descendants().filter(children__isnull=True)))
 
-    def _get_leaves(self, dt):
+    @classmethod
+    @instrumented
+    def bulk_add_edges(cls, pairs, **kwargs):
         """
-        Works on objects: no queries
+        Adds many edges at once from (parent, child) pairs of nodes or
+        primary keys, extra keyword arguments are set on every edge.
+
+        The whole batch is checked for cycles against the existing graph
+        and a ValidationError lists all the offending edges; otherwise
+        the edges are inserted in a single transaction.
         """
-        if not dt:
-          return set([self])
-        leaves = set()
-        for d2 in dt:
-            leaves.update(d2._get_leaves(dt[d2]))
-        return leaves
+        edge_model = cls.children.through
+        parent_field, child_field = cls._dag_edge_fields()
+        pairs = [(getattr(p, 'pk', p), getattr(c, 'pk', c)) for p, c in pairs]
 
-    def get_leaves(self):
+        with transaction.atomic(using=router.db_for_write(edge_model)):
+            children = {}
+            for parent, child in _edge_pk_pairs(edge_model) + pairs:
+                children.setdefault(parent, []).append(child)
+            errors = []
+            for parent, child in cycle_edges(children, pairs):
+                if parent == child:
+                    message = 'Self links are not allowed: %(parent)s.'
+                else:
+                    message = 'The edge %(parent)s -> %(child)s creates a cycle.'
+                errors.append(ValidationError(message, code='cycle',
+                                              params={'parent': parent, 'child': child}))
+            if errors:
+                raise ValidationError(errors)
+
+            edges = []
+            for values in cls._dag_edge_values(pairs):
+                edge = edge_model(**kwargs)
+                for field, value in zip((parent_field, child_field), values):
+                    setattr(edge, field.attname, value)
+                edges.append(edge)
+            edges = edge_model.objects.bulk_create(edges, batch_size=500)
+
+            invalidate_edges(cls, pairs)
+            if cls._dag_rebuild_batch(pairs):
+                cls._dag_rebuild()
+            else:
+                for index in (cls._dag_closure_model(), cls._dag_reachability_model()):
+                    if index is not None:
+                        for parent, child in pairs:
+                            index.add_edge(parent, child)
+                cls._dag_edges_changed(pairs, 1)
+        return edges
+
+    @classmethod
+    def _dag_rebuild_batch(cls, pairs):
         """
-        Returns leaves nodes, if any
+        Tells if a batch of added or removed edges is large enough, against
+        the edge table, to rebuild the maintained tables, see
+        dag_rebuild_ratio
+        """
+        maintained = (cls._dag_closure_model() is not None or
+                      cls._dag_reachability_model() is not None or cls.dag_denormalized)
+        if not maintained or cls.dag_rebuild_ratio is None:
+            return False
+        return len(pairs) > cls.dag_rebuild_ratio * cls.children.through.objects.count()
+
+    @classmethod
+    def _dag_rebuild(cls):
+        """
+        Rebuilds the closure, the reachability index and the denormalized
+        fields from the edge table
+        """
+        for index in (cls._dag_closure_model(), cls._dag_reachability_model()):
+            if index is not None:
+                index.rebuild()
+        if cls.dag_denormalized:
+            cls.rebuild_denormalized()
+
+    @classmethod
+    def _dag_edge_values(cls, pairs):
+        """
+        Returns the (parent, child) values stored in the edge table for
+        pairs of primary keys: edges store the node fields they point to
         """
-        dt =  self.descendants_tree()
-        leaves = set()
-        for d in dt:
-            leaves.update(d._get_leaves(dt[d]))
-        return leaves
+        lookups = []
+        for index, field in enumerate(cls._dag_edge_fields()):
+            if field.target_field.primary_key:
+                lookups.append(None)
+            else:
+                pks = set(pair[index] for pair in pairs)
+                lookups.append(dict(cls.objects.filter(pk__in=pks).values_list(
+                    'pk', field.target_field.attname)))
+        return [tuple(pk if lookup is None else lookup[pk] for lookup, pk in zip(lookups, pair))
+                for pair in pairs]
 
+    @classmethod
+    def _dag_delete_edges(cls, edges):
+        """
+        Deletes a QuerySet of edges, then updates the closure, the cache
+        and the denormalized fields once for all of them. Signals and
+        cascades go through QuerySet.delete(): without receivers nor
+        related models it is a single DELETE statement.
+        """
+        closure = cls._dag_closure_model()
+        index = cls._dag_reachability_model()
+        label = edges.model._meta.label
+        if closure is None and index is None and cls.dag_cache is None and not cls.dag_denormalized:
+            return edges.delete()[1].get(label, 0)
+        with transaction.atomic(using=router.db_for_write(edges.model)):
+            pairs = list(edges.values_list('parent__pk', 'child__pk'))
+            if not pairs:
+                return 0
+            invalidate_edges(cls, pairs)
+            rebuild = cls._dag_rebuild_batch(pairs)
+            with bulk_deletion(edges.model):
+                count = edges.delete()[1].get(label, 0)
+            if rebuild:
+                cls._dag_rebuild()
+                return count
+            for index in (closure, index):
+                if index is not None:
+                    index.remove_edges(pairs)
+            cls._dag_edges_changed(pairs, -1)
+        return count
+
+    @classmethod
+    @instrumented
+    def remove_edges(cls, pairs):
+        """
+        Removes the edges between (parent, child) pairs of nodes or
+        primary keys in bulk, returns the number of edges removed
+        """
+        pairs = [(getattr(p, 'pk', p), getattr(c, 'pk', c)) for p, c in pairs]
+        if not pairs:
+            return 0
+        parent_field, child_field = cls._dag_edge_fields()
+        values = cls._dag_edge_values(pairs)
+        size = (cls._dag_connection().features.max_query_params or len(values) * 2) // 2
+        batches = []
+        for i in range(0, len(values), size):
+            match = models.Q()
+            for parent, child in values[i:i + size]:
+                match |= models.Q(**{parent_field.attname: parent, child_field.attname: child})
+            batches.append(cls.children.through.objects.filter(match))
+        if len(batches) == 1:
+            return cls._dag_delete_edges(batches[0])
+        with transaction.atomic(using=router.db_for_write(cls.children.through)):
+            return sum(cls._dag_delete_edges(edges) for edges in batches)
+
+    @instrumented
+    def detach_all_children(self):
+        """
+        Removes all the edges to the children, returns their number
+        """
+        return self._dag_delete_edges(self.children.through.objects.filter(parent=self))
+
+    @instrumented
+    def detach_all_parents(self):
+        """
+        Removes all the edges from the parents, returns their number
+        """
+        return self._dag_delete_edges(self.children.through.objects.filter(child=self))
+
+    @instrumented
+    def delete_subgraph(self):
+        """
+        Deletes self and all its descendants, even the ones having other
+        parents, returns the number of nodes deleted
+        """
+        cls = self.__class__
+        pks = [self.pk] + list(cls._dag_reachable_pks([self.pk]))
+        edges = cls.children.through.objects
+        size = cls._dag_connection().features.max_query_params or len(pks)
+        count = 0
+        with transaction.atomic(using=router.db_for_write(cls)):
+            for i in range(0, len(pks), size):
+                nodes = cls.objects.filter(pk__in=pks[i:i + size])
+                cls._dag_delete_edges(edges.filter(models.Q(parent__in=nodes) | models.Q(child__in=nodes)))
+            for i in range(0, len(pks), size):
+                count += cls.objects.filter(pk__in=pks[i:i + size]).delete()[1].get(cls._meta.label, 0)
+        return count
+
+    @classmethod
+    def _dag_edges_changed(cls, pairs, sign):
+        """
+        Updates the denormalized fields after adding (sign 1) or removing
+        (sign -1) the edges in pairs of (parent, child) primary keys
+        """
+        if not cls.dag_denormalized or not pairs:
+            return
+        for field, index in (('child_count', 0), ('parent_count', 1)):
+            counts = {}
+            for pair in pairs:
+                counts[pair[index]] = counts.get(pair[index], 0) + 1
+            by_count = {}
+            for pk, count in counts.items():
+                by_count.setdefault(count, []).append(pk)
+            for count, pks in by_count.items():
+                cls.objects.filter(pk__in=pks).update(**{field: models.F(field) + sign * count})
+        cls._dag_update_depths(set(child for parent, child in pairs))
+
+    @classmethod
+    def _dag_update_depths(cls, pks):
+        """
+        Recomputes the min_depth and max_depth of the nodes and of their
+        descendants from the depths stored in their other parents
+        """
+        nodes = set(pks) | cls._dag_reachable_pks(pks)
+        parents = dict((pk, []) for pk in nodes)
+        for pk, parent in cls._dag_adjacency(nodes, reverse=True):
+            parents[pk].append(parent)
+        children = dict((pk, []) for pk in nodes)
+        for pk, node_parents in parents.items():
+            for parent in node_parents:
+                if parent in nodes:
+                    children[parent].append(pk)
+        wanted = list(nodes.union(*parents.values()))
+        size = cls._dag_connection().features.max_query_params or len(wanted) or 1
+        stored = {}
+        for i in range(0, len(wanted), size):
+            rows = cls.objects.filter(pk__in=wanted[i:i + size])
+            stored.update((pk, (low, high)) for pk, low, high in
+                          rows.values_list('pk', 'min_depth', 'max_depth'))
+        depths = dict(stored)
+        order, cyclic = topological_sort(children)
+        for pk in order:
+            above = [depths[parent] for parent in parents[pk]]
+            if above:
+                depths[pk] = (min(d[0] for d in above) + 1, max(d[1] for d in above) + 1)
+            else:
+                depths[pk] = (0, 0)
+        cls._dag_store_depths(dict((pk, depths[pk]) for pk in order if depths[pk] != stored.get(pk)))
+
+    @classmethod
+    def _dag_store_depths(cls, depths):
+        """
+        Saves a dict mapping primary keys to (min_depth, max_depth)
+        """
+        by_depth = {}
+        for pk, depth in depths.items():
+            by_depth.setdefault(depth, []).append(pk)
+        size = cls._dag_connection().features.max_query_params or 500
+        for (low, high), pks in by_depth.items():
+            for i in range(0, len(pks), size):
+                cls.objects.filter(pk__in=pks[i:i + size]).update(min_depth=low, max_depth=high)
+
+    @classmethod
+    def rebuild_denormalized(cls):
+        """
+        Recomputes the denormalized fields of all the nodes from the edge
+        table, for nodes created with node_factory(denormalize=True)
+        """
+        children = cls._dag_graph()
+        parent_counts = {}
+        for pk, node_children in children.items():
+            for child in node_children:
+                parent_counts[child] = parent_counts.get(child, 0) + 1
+        longest = depth_map(children)
+        shortest = depth_map(children, longest=False)
+        by_counts = {}
+        for pk in children:
+            by_counts.setdefault((len(children[pk]), parent_counts.get(pk, 0)), []).append(pk)
+        with transaction.atomic(using=router.db_for_write(cls)):
+            cls.objects.update(child_count=0, parent_count=0, min_depth=0, max_depth=0)
+            size = cls._dag_connection().features.max_query_params or 500
+            for (child_count, parent_count), pks in by_counts.items():
+                for i in range(0, len(pks), size):
+                    cls.objects.filter(pk__in=pks[i:i + size]).update(
+                        child_count=child_count, parent_count=parent_count)
+            cls._dag_store_depths(dict((pk, (shortest[pk], longest[pk])) for pk in children
+                                       if longest[pk]))
+
+    @classmethod
+    def _dag_lock_edge(cls, parent_pk, child_pk):
+        """
+        Locks the parent, its ancestors, the child and its descendants
+        until the end of the transaction, returns the descendants of the
+        child.
+
+        The nodes are looked up again after locking until no new one
+        shows up: a concurrent edge can only extend these sets through a
+        locked node, so they stay frozen until the transaction ends.
+        """
+        locked = set()
+        while True:
+            descendants = cls._dag_reachable_pks([child_pk])
+            wanted = set([parent_pk, child_pk]) | descendants
+            wanted.update(cls._dag_reachable_pks([parent_pk], reverse=True))
+            missing = wanted - locked
+            if not missing:
+                return descendants
+            cls._dag_lock_nodes(missing)
+            locked.update(missing)
+
+    @classmethod
+    def _dag_lock_nodes(cls, pks):
+        """
+        Locks the nodes, in primary key order to avoid deadlocks
+        """
+        pks = sorted(pks)
+        using = router.db_for_write(cls)
+        size = connections[using].features.max_query_params or len(pks)
+        if cls.dag_locking == 'advisory':
+            table = zlib.crc32(cls._meta.db_table.encode('utf-8')) & 0x7fffffff
+            keys = sorted(set(pk & 0x7fffffff if isinstance(pk, int) else
+                              zlib.crc32(str(pk).encode('utf-8')) & 0x7fffffff for pk in pks))
+            with connections[using].cursor() as cursor:
+                for key in keys:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [table, key])
+        elif cls.dag_locking == 'rows':
+            for i in range(0, len(pks), size):
+                nodes = cls.objects.using(using).select_for_update().filter(pk__in=pks[i:i + size])
+                list(nodes.order_by('pk').values_list('pk', flat=True))
+        else:
+            raise ValueError("dag_locking must be 'rows' or 'advisory', not %r" % (cls.dag_locking,))
 
     @staticmethod
     def circular_checker(parent, child):
@@ -262,25 +1486,76 @@ class NodeBase(object):
         """
         if parent == child:
             raise ValidationError('Self links are not allowed.')
-        if child in parent.ancestors_set():
+        if child.is_ancestor_of(parent):
             raise ValidationError('The object is an ancestor.')
 
 
-def edge_factory(node_model, child_to_field = "id", parent_to_field = "id", concrete = True, base_model = models.Model):
+def _model_name(model):
     """
-    Dag Edge factory
+    Returns the name used in related names for a model or model reference
     """
     try:
         basestring
     except NameError:
         basestring = str
-    if isinstance(node_model, basestring):
+    if isinstance(model, basestring):
         try:
-            node_model_name = node_model.split('.')[1]
+            return model.split('.')[1]
         except IndexError:
-            node_model_name = node_model
-    else:
-        node_model_name = node_model._meta.model_name
+            return model
+    return model._meta.model_name
+
+
+def _edge_pk_pairs(edge_model, using=None):
+    """
+    Returns the (parent pk, child pk) tuples of all the edges, read from
+    the database using, the routed one by default
+    """
+    parent = edge_model._meta.get_field('parent')
+    child = edge_model._meta.get_field('child')
+    pairs = edge_model.objects.using(using).values_list(parent.attname, child.attname)
+    if parent.target_field.primary_key and child.target_field.primary_key:
+        return list(pairs)
+    nodes = parent.related_model.objects.using(using)
+    parent_pks = dict(nodes.values_list(parent.target_field.attname, 'pk'))
+    child_pks = dict(nodes.values_list(child.target_field.attname, 'pk'))
+    return [(parent_pks[p], child_pks[c]) for p, c in pairs]
+
+
+def _saved_fields(node, update_fields):
+    """
+    Returns the fields saved on a denormalized node: the loaded fields or
+    update_fields, without the denormalized ones
+    """
+    if update_fields is None:
+        deferred = node.get_deferred_fields()
+        update_fields = [f.name for f in node._meta.concrete_fields
+                         if not f.primary_key and f.attname not in deferred]
+    return [name for name in update_fields if name not in DENORMALIZED_FIELDS]
+
+
+def _count_edge(parent, child, sign):
+    """
+    Updates the denormalized counts of loaded nodes after adding (sign 1)
+    or removing (sign -1) the edge between them
+    """
+    if parent.dag_denormalized:
+        parent.child_count += sign
+        child.parent_count += sign
+
+
+def _edge_post_delete(sender, instance, **kwargs):
+    if in_bulk_deletion(sender):
+        return
+    node_model = sender._meta.get_field('parent').related_model
+    node_model._dag_edges_changed([instance._dag_node_pks()], -1)
+
+
+def edge_factory(node_model, child_to_field = "id", parent_to_field = "id", concrete = True, base_model = models.Model):
+    """
+    Dag Edge factory
+    """
+    node_model_name = _model_name(node_model)
 
     class Edge(base_model):
         class Meta:
@@ -292,21 +1567,463 @@ def edge_factory(node_model, child_to_field = "id", parent_to_field = "id", conc
         def __unicode__(self):
             return u"%s is child of %s" % (self.child, self.parent)
 
+        def _dag_node_pks(self):
+            """
+            Returns the primary keys of parent and child
+            """
+            pks = []
+            for name in ('parent', 'child'):
+                field = self._meta.get_field(name)
+                if field.target_field.primary_key:
+                    pks.append(getattr(self, field.attname))
+                else:
+                    pks.append(getattr(self, name).pk)
+            return tuple(pks)
+
+        @classmethod
+        def bulk_add_edges(cls, pairs, **kwargs):
+            """
+            Adds many edges at once, see NodeBase.bulk_add_edges()
+            """
+            return cls._meta.get_field('parent').related_model.bulk_add_edges(pairs, **kwargs)
+
         def save(self, *args, **kwargs):
-            if not kwargs.pop('disable_circular_check', False):
-                self.parent.__class__.circular_checker(self.parent, self.child)
-            super(Edge, self).save(*args, **kwargs) # Call the "real" save() method.
+            check = not kwargs.pop('disable_circular_check', False)
+            node_model = self._meta.get_field('parent').related_model
+            if node_model.dag_locking is None or not self._state.adding:
+                if check:
+                    self.parent.__class__.circular_checker(self.parent, self.child)
+                return self._dag_save(*args, **kwargs)
+            with transaction.atomic(using=router.db_for_write(self.__class__)):
+                parent_pk, child_pk = self._dag_node_pks()
+                descendants = node_model._dag_lock_edge(parent_pk, child_pk)
+                # The locked sets replace circular_checker, whose queries
+                # may be answered by a stale traversal cache
+                if check and parent_pk == child_pk:
+                    raise ValidationError('Self links are not allowed.')
+                if check and parent_pk in descendants:
+                    raise ValidationError('The object is an ancestor.')
+                return self._dag_save(*args, **kwargs)
+
+        def _dag_save(self, *args, **kwargs):
+            node_model = self._meta.get_field('parent').related_model
+            closure = node_model._dag_closure_model()
+            index = node_model._dag_reachability_model()
+            maintained = closure is not None or index is not None or node_model.dag_denormalized
+            if not maintained and (self._state.adding or node_model.dag_cache is None):
+                return super(Edge, self).save(*args, **kwargs) # Call the "real" save() method.
+            old = None
+            if not self._state.adding:
+                # Moving an edge removes the old pair and adds the new one
+                old = self.__class__.objects.filter(pk=self.pk).values_list('parent__pk', 'child__pk').first()
+            with transaction.atomic(using=router.db_for_write(self.__class__)):
+                super(Edge, self).save(*args, **kwargs)
+                pks = self._dag_node_pks()
+                if old == pks:
+                    return
+                if old is not None:
+                    invalidate_edges(node_model, [old])
+                    if closure is not None:
+                        closure.remove_edges([old])
+                    if index is not None:
+                        index.remove_edges([old])
+                    node_model._dag_edges_changed([old], -1)
+                if closure is not None:
+                    closure.add_edge(*pks)
+                if index is not None:
+                    index.add_edge(*pks)
+                node_model._dag_edges_changed([pks], 1)
+            if old is None:
+                _count_edge(self.parent, self.child, 1)
 
     return Edge
 
-def node_factory(edge_model, children_null = True, base_model = models.Model):
+
+def closure_factory(node_model, edge_model, concrete = True, base_model = models.Model):
+    """
+    Dag transitive closure factory
+
+    Each row tells that a path of a given length (depth) leads from
+    ancestor to descendant. Saved edges add the rows joining the paths
+    ending in the parent with the paths starting from the child, deleted
+    edges recompute the rows of the parent and of its ancestors from the
+    remaining edges.
+    """
+    node_model_name = _model_name(node_model)
+
+    class Closure(base_model):
+        class Meta:
+            abstract = not concrete
+            unique_together = (CLOSURE_UNIQUE,)
+
+        dag_closure = True
+        dag_edge_model = edge_model
+
+        ancestor = models.ForeignKey(node_model, related_name = "%s_descendant_paths" % node_model_name, on_delete=models.CASCADE)
+        descendant = models.ForeignKey(node_model, related_name = "%s_ancestor_paths" % node_model_name, on_delete=models.CASCADE)
+        depth = models.PositiveIntegerField()
+
+        def __unicode__(self):
+            return u"%s reaches %s in %s hops" % (self.ancestor, self.descendant, self.depth)
+
+        @classmethod
+        def add_edge(cls, parent_pk, child_pk):
+            """
+            Adds the paths through a new edge
+            """
+            above = [(parent_pk, 0)]
+            above.extend(cls.objects.filter(descendant=parent_pk).values_list('ancestor', 'depth'))
+            below = [(child_pk, 0)]
+            below.extend(cls.objects.filter(ancestor=child_pk).values_list('descendant', 'depth'))
+            wanted = set((ancestor, descendant, ancestor_depth + descendant_depth + 1)
+                         for ancestor, ancestor_depth in above
+                         for descendant, descendant_depth in below)
+            existing = cls.objects.filter(
+                models.Q(ancestor=parent_pk) |
+                models.Q(ancestor__in=cls.objects.filter(descendant=parent_pk).values('ancestor')),
+                models.Q(descendant=child_pk) |
+                models.Q(descendant__in=cls.objects.filter(ancestor=child_pk).values('descendant')),
+            )
+            wanted.difference_update(existing.values_list('ancestor', 'descendant', 'depth'))
+            cls.objects.bulk_create([
+                cls(ancestor_id=ancestor, descendant_id=descendant, depth=depth)
+                for ancestor, descendant, depth in wanted], batch_size=500)
+
+        @classmethod
+        def remove_edge(cls, parent_pk, child_pk):
+            """
+            Removes the paths through a deleted edge
+            """
+            cls.remove_edges([(parent_pk, child_pk)])
+
+        @classmethod
+        def _rows_below(cls, ancestors, parents):
+            """
+            Returns a dict mapping the (ancestor, descendant, depth) rows
+            from the ancestors to the descendants of the parents to their
+            primary key
+            """
+            rows = {}
+            for i in range(0, len(ancestors), 250):
+                for j in range(0, len(parents), 250):
+                    below = cls.objects.filter(ancestor__in=parents[j:j + 250]).values('descendant')
+                    found = cls.objects.filter(ancestor__in=ancestors[i:i + 250], descendant__in=below)
+                    for pk, ancestor, descendant, depth in found.values_list(
+                            'pk', 'ancestor', 'descendant', 'depth'):
+                        rows[(ancestor, descendant, depth)] = pk
+            return rows
+
+        @classmethod
+        def remove_edges(cls, pairs):
+            """
+            Recomputes, from the remaining edges, the rows that may go
+            through deleted edges, pairs of (parent, child) primary keys:
+            the rows from the parents and their ancestors to the nodes below
+            the parents. The nodes below the children would do, but their
+            rows go away with a deleted child; the rows of a deleted parent
+            are recomputed through the edges into it, deleted too.
+            """
+            parents = list(set(parent for parent, child in pairs))
+            above = set(parents)
+            below = set()
+            for i in range(0, len(parents), 500):
+                above.update(cls.objects.filter(descendant__in=parents[i:i + 500]).values_list(
+                    'ancestor', flat=True))
+                below.update(cls.objects.filter(ancestor__in=parents[i:i + 500]).values_list(
+                    'descendant', flat=True))
+            nodes = list(above)
+            links = dict((pk, []) for pk in nodes)
+            for i in range(0, len(nodes), 500):
+                edges = cls.dag_edge_model.objects.filter(parent__pk__in=nodes[i:i + 500])
+                for parent, child in edges.values_list('parent__pk', 'child__pk'):
+                    links[parent].append(child)
+            stored = cls._rows_below(nodes, parents)
+            # The nodes outside the ancestors of the parents keep their rows
+            reached = {}
+            outside = list(set(c for node_children in links.values() for c in node_children) - above)
+            for ancestor, descendant, depth in cls._rows_below(outside, parents):
+                reached.setdefault(ancestor, set()).add((descendant, depth))
+            wanted = set()
+            for node in postorder(links):
+                if node not in above:
+                    continue
+                paths = set()
+                for child in links[node]:
+                    if child in below:
+                        paths.add((child, 1))
+                    paths.update((descendant, depth + 1) for descendant, depth in reached.get(child, ()))
+                reached[node] = paths
+                wanted.update((node, descendant, depth) for descendant, depth in paths)
+            stale = [pk for key, pk in stored.items() if key not in wanted]
+            for i in range(0, len(stale), 500):
+                cls.objects.filter(pk__in=stale[i:i + 500]).delete()
+            cls.objects.bulk_create([
+                cls(ancestor_id=ancestor, descendant_id=descendant, depth=depth)
+                for ancestor, descendant, depth in wanted
+                if (ancestor, descendant, depth) not in stored], batch_size=500)
+
+        @classmethod
+        def rebuild(cls):
+            """
+            Recomputes all the rows from the edge table
+            """
+            children = {}
+            for parent, child in _edge_pk_pairs(cls.dag_edge_model):
+                children.setdefault(parent, []).append(child)
+            # (descendant, depth) pairs of every node visited so far
+            below = {}
+            rows = []
+            for node in postorder(children):
+                reached = set()
+                for child in children.get(node, ()):
+                    reached.add((child, 1))
+                    reached.update((descendant, depth + 1) for descendant, depth in below[child])
+                below[node] = reached
+                rows.extend(cls(ancestor_id=node, descendant_id=descendant, depth=depth)
+                            for descendant, depth in reached)
+            with transaction.atomic(using=router.db_for_write(cls)):
+                cls.objects.all().delete()
+                cls.objects.bulk_create(rows, batch_size=500)
+
+        @classmethod
+        def _edge_post_delete(cls, sender, instance, **kwargs):
+            if not in_bulk_deletion(sender):
+                cls.remove_edges([instance._dag_node_pks()])
+
+    return Closure
+
+
+def reachability_factory(node_model, edge_model, concrete = True, base_model = models.Model):
+    """
+    Dag reachability index factory
+
+    Nodes are labelled with their postorder number and store, as rows,
+    the intervals of the labels of the nodes they reach, themselves
+    included: a node is an ancestor of another one if its intervals
+    hold the other label. Edges of the depth first spanning tree keep
+    the labels consecutive, the other edges add intervals.
+
+    Rows are merged above saved edges and recomputed above deleted
+    ones, new nodes are labelled past the last label. rebuild(), or the
+    dag_reachability management command, renumbers the whole graph.
+    """
+    node_model_name = _model_name(node_model)
+
+    class Reachability(base_model):
+        class Meta:
+            abstract = not concrete
+
+        dag_reachability = True
+        dag_edge_model = edge_model
+
+        node = models.ForeignKey(node_model, related_name = "%s_reachability" % node_model_name, on_delete=models.CASCADE)
+        label = models.PositiveIntegerField(db_index=True)
+        low = models.PositiveIntegerField(db_index=True)
+        high = models.PositiveIntegerField()
+
+        def __unicode__(self):
+            return u"%s reaches labels %s to %s" % (self.node, self.low, self.high)
+
+        @classmethod
+        def labels(cls, pks):
+            """
+            Returns a dict mapping the indexed nodes among pks, a list or a
+            values QuerySet of primary keys, to their (label, intervals)
+            """
+            if not isinstance(pks, models.QuerySet):
+                pks = list(pks)
+                if len(pks) > 500:
+                    labels = {}
+                    for i in range(0, len(pks), 500):
+                        labels.update(cls.labels(pks[i:i + 500]))
+                    return labels
+            labels = {}
+            rows = cls.objects.filter(node__in=pks).order_by('low')
+            for node, label, low, high in rows.values_list('node', 'label', 'low', 'high'):
+                labels.setdefault(node, (label, []))[1].append((low, high))
+            return labels
+
+        @classmethod
+        def reaches(cls, ancestor_pk, descendant_pk):
+            """
+            Checks if a path leads from ancestor to descendant, from the
+            labels of both nodes read in one query
+            """
+            labels = cls.labels([ancestor_pk, descendant_pk])
+            if ancestor_pk == descendant_pk or ancestor_pk not in labels or descendant_pk not in labels:
+                return False
+            return intervals_contain(labels[ancestor_pk][1], labels[descendant_pk][0])
+
+        @classmethod
+        def _above(cls, labels):
+            """
+            Returns the values QuerySet of the nodes reaching labels, a
+            hundred at most: SQLite limits the depth of the OR expression
+            """
+            match = models.Q()
+            for label in labels:
+                match |= models.Q(low__lte=label, high__gte=label)
+            return cls.objects.filter(match).values('node')
+
+        @classmethod
+        def _store(cls, labels):
+            """
+            Replaces the rows of the nodes of a dict mapping them to their
+            (label, intervals)
+            """
+            pks = list(labels)
+            for i in range(0, len(pks), 500):
+                cls.objects.filter(node__in=pks[i:i + 500]).delete()
+            cls.objects.bulk_create([
+                cls(node_id=pk, label=label, low=low, high=high)
+                for pk, (label, intervals) in labels.items() for low, high in intervals],
+                batch_size=500)
+
+        @classmethod
+        def add_edge(cls, parent_pk, child_pk):
+            """
+            Adds the labels reached through a new edge to the parent and
+            its ancestors
+            """
+            labels = cls.labels([parent_pk, child_pk])
+            missing = [pk for pk in (parent_pk, child_pk) if pk not in labels]
+            if missing:
+                last = cls.objects.aggregate(models.Max('label'))['label__max'] or 0
+                for number, pk in enumerate(missing, last + 1):
+                    labels[pk] = (number, [(number, number)])
+                cls._store(dict((pk, labels[pk]) for pk in missing))
+            if intervals_contain(labels[parent_pk][1], labels[child_pk][0]):
+                return
+            reached = labels[child_pk][1]
+            changed = {}
+            for pk, (label, intervals) in cls.labels(cls._above([labels[parent_pk][0]])).items():
+                merged = merge_intervals(intervals + reached)
+                if merged != intervals:
+                    changed[pk] = (label, merged)
+            cls._store(changed)
+
+        @classmethod
+        def remove_edges(cls, pairs):
+            """
+            Recomputes the intervals of the parents of deleted edges and of
+            their ancestors, pairs are (parent, child) primary keys
+            """
+            parents = cls.labels(set(parent for parent, child in pairs))
+            if not parents:
+                return
+            labels = [label for label, intervals in parents.values()]
+            above = {}
+            for i in range(0, len(labels), 100):
+                above.update(cls.labels(cls._above(labels[i:i + 100])))
+            nodes = list(above)
+            children = dict((pk, []) for pk in nodes)
+            for i in range(0, len(nodes), 500):
+                edges = cls.dag_edge_model.objects.filter(parent__pk__in=nodes[i:i + 500])
+                for parent, child in edges.values_list('parent__pk', 'child__pk'):
+                    children.setdefault(parent, []).append(child)
+            below = set(c for node_children in children.values() for c in node_children)
+            known = cls.labels(below - set(above))
+            changed = {}
+            for pk in postorder(children):
+                if pk not in above:
+                    continue
+                label, intervals = above[pk]
+                merged = [(label, label)]
+                for child in children[pk]:
+                    if child in known:
+                        merged.extend(known[child][1])
+                merged = merge_intervals(merged)
+                known[pk] = (label, merged)
+                if merged != intervals:
+                    changed[pk] = (label, merged)
+            cls._store(changed)
+
+        @classmethod
+        def rebuild(cls):
+            """
+            Labels all the nodes from the edge table
+            """
+            node_model = cls._meta.get_field('node').related_model
+            children = dict((pk, []) for pk in node_model.objects.values_list('pk', flat=True))
+            for parent, child in _edge_pk_pairs(cls.dag_edge_model):
+                children[parent].append(child)
+            rows = [cls(node_id=pk, label=label, low=low, high=high)
+                    for pk, (label, intervals) in interval_labels(children).items()
+                    for low, high in intervals]
+            with transaction.atomic(using=router.db_for_write(cls)):
+                cls.objects.all().delete()
+                cls.objects.bulk_create(rows, batch_size=500)
+
+        @classmethod
+        def _edge_post_delete(cls, sender, instance, **kwargs):
+            if not in_bulk_deletion(sender):
+                cls.remove_edges([instance._dag_node_pks()])
+
+    return Reachability
+
+
+def _prepare_closure(sender, **kwargs):
+    """
+    Binds a concrete closure or reachability index model to the deletions
+    of its edge model
+    """
+    if getattr(sender, 'dag_reachability', False):
+        def bind(index, edge):
+            index.dag_edge_model = edge
+            # The intervals are recomputed from the remaining edges
+            post_delete.connect(index._edge_post_delete, sender=edge, weak=False,
+                                dispatch_uid='django_dag_reachability_%s' % index._meta.label_lower)
+
+        lazy_related_operation(bind, sender, sender.dag_edge_model)
+    if not getattr(sender, 'dag_closure', False):
+        return
+    if not sender._meta.abstract and CLOSURE_UNIQUE not in sender._meta.unique_together:
+        # The Meta of a subclass replaces the one of closure_factory
+        sender._meta.unique_together += (CLOSURE_UNIQUE,)
+
+    def bind(closure, edge):
+        closure.dag_edge_model = edge
+        # The rows are recomputed from the remaining edges
+        post_delete.connect(closure._edge_post_delete, sender=edge, weak=False,
+                            dispatch_uid='django_dag_closure_%s' % closure._meta.label_lower)
+
+    lazy_related_operation(bind, sender, sender.dag_edge_model)
+
+class_prepared.connect(_prepare_closure)
+
+
+def _prepare_node(sender, **kwargs):
+    """
+    Connects the cache invalidation of nodes declaring a dag_cache and
+    the maintenance of denormalized nodes to their edges
+    """
+    if getattr(sender, 'dag_cache', None) is not None:
+        connect_signals(sender)
+    if getattr(sender, 'dag_denormalized', False) and not sender._meta.abstract:
+        def bind(node, edge):
+            post_delete.connect(_edge_post_delete, sender=edge,
+                                dispatch_uid='django_dag_denormalized_%s' % edge._meta.label_lower)
+
+        lazy_related_operation(bind, sender, sender._meta.get_field('children').remote_field.through)
+
+class_prepared.connect(_prepare_node)
+
+
+def node_factory(edge_model, children_null = True, base_model = models.Model, denormalize = False):
     """
     Dag Node factory
+
+    With denormalize, nodes get indexed child_count, parent_count,
+    min_depth and max_depth fields (the shortest and longest paths from
+    a root) updated when edges are saved or deleted, and used by the
+    root, leaf and island predicates and filters.
     """
     class Node(base_model, NodeBase):
         class Meta:
             abstract        = True
 
+        objects = DagQuerySet.as_manager()
+
         children  = models.ManyToManyField(
                 'self',
                 blank       = children_null,
@@ -314,4 +2031,20 @@ def node_factory(edge_model, children_null = True, base_model = models.Model):
                 through     = edge_model,
                 related_name = '_parents') # NodeBase.parents() is a function
 
+        if denormalize:
+            dag_denormalized = True
+            child_count = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+            parent_count = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+            min_depth = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+            max_depth = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+
+            def save(self, *args, **kwargs):
+                """
+                Saves the node but its denormalized fields, written by the
+                edges with F() updates: a stale instance would overwrite them
+                """
+                if not self._state.adding and not kwargs.get('force_insert'):
+                    kwargs['update_fields'] = _saved_fields(self, kwargs.get('update_fields'))
+                return super(Node, self).save(*args, **kwargs)
+
     return Node
@@ -0,0 +1,125 @@
+"""
+SQL helpers to compute graph closures in a single query.
+
+The queries are built on the edge table created by edge_factory and use
+recursive common table expressions, supported by SQLite (3.8.3+) and
+PostgreSQL.
+"""
+
+from django.db.models.expressions import RawSQL
+
+CTE_VENDORS = ('sqlite', 'postgresql')
+
+
+class SubquerySQL(RawSQL):
+    """
+    Raw subquery for the right hand side of an __in lookup, the lookup
+    adds the enclosing parentheses (a second pair would turn the
+    subquery into a scalar on SQLite and PostgreSQL)
+    """
+    def as_sql(self, compiler, connection):
+        return self.sql, self.params
+
+
+def supports_recursive_cte(connection):
+    """
+    Checks if the database behind connection runs WITH RECURSIVE queries
+    """
+    return connection.vendor in CTE_VENDORS
+
+
+def edge_columns(edge_model, connection):
+    """
+    Returns the quoted (table, parent column, child column) of the edge model
+    """
+    qn = connection.ops.quote_name
+    opts = edge_model._meta
+    return (qn(opts.db_table),
+            qn(opts.get_field('parent').column),
+            qn(opts.get_field('child').column))
+
+
+def closure_sql(edge_model, connection, start, reverse=False):
+    """
+    Returns (sql, params) selecting the ids of all the nodes reachable
+    from the nodes in start, following the edges downwards (descendants)
+    or upwards when reverse is True (ancestors). Start is a list of ids
+    or a QuerySet selecting them.
+
+    The start nodes themselves are not part of the result unless they are
+    reachable from another start node.
+    """
+    table, parent, child = edge_columns(edge_model, connection)
+    if reverse:
+        parent, child = child, parent
+    if hasattr(start, 'query'):
+        start, params = start.query.get_compiler(connection=connection).as_sql()
+    else:
+        start, params = ', '.join(['%s'] * len(start)), list(start)
+    sql = ('WITH RECURSIVE dag_closure(node_id) AS ('
+           'SELECT %(child)s FROM %(table)s WHERE %(parent)s IN (%(start)s) '
+           'UNION '
+           'SELECT e.%(child)s FROM %(table)s e '
+           'INNER JOIN dag_closure c ON e.%(parent)s = c.node_id'
+           ') SELECT node_id FROM dag_closure') % {
+               'table': table,
+               'parent': parent,
+               'child': child,
+               'start': start,
+           }
+    return sql, params
+
+
+def reachable_sql(edge_model, connection, source, target, reverse=False):
+    """
+    Returns (sql, params) selecting one row if target is reachable from
+    source, following the edges downwards or upwards when reverse is True
+    """
+    sql, params = closure_sql(edge_model, connection, [source], reverse=reverse)
+    return '%s WHERE node_id = %%s LIMIT 1' % sql, params + [target]
+
+
+def component_sql(edge_model, connection, start):
+    """
+    Returns (sql, params) selecting the ids of the nodes connected to
+    start, following the edges in both directions
+    """
+    table, parent, child = edge_columns(edge_model, connection)
+    sql = ('WITH RECURSIVE dag_component(node_id) AS ('
+           'SELECT %%s '
+           'UNION '
+           'SELECT CASE WHEN e.%(parent)s = c.node_id THEN e.%(child)s ELSE e.%(parent)s END '
+           'FROM %(table)s e '
+           'INNER JOIN dag_component c ON e.%(parent)s = c.node_id OR e.%(child)s = c.node_id'
+           ') SELECT node_id FROM dag_component') % {
+               'table': table,
+               'parent': parent,
+               'child': child,
+           }
+    return sql, [start]
+
+
+def depth_sql(edge_model, connection, node_column, longest=True):
+    """
+    Returns the sql of a scalar subquery computing the depth of the node
+    whose id is in node_column, a qualified column of the outer query:
+    the length of the longest path from a root, or of the shortest one
+    """
+    table, parent, child = edge_columns(edge_model, connection)
+    if longest:
+        select = 'SELECT COALESCE(MAX(depth), 0) FROM dag_depth'
+    else:
+        select = ('SELECT MIN(depth) FROM dag_depth '
+                  'WHERE node_id NOT IN (SELECT %(child)s FROM %(table)s)')
+    sql = ('WITH RECURSIVE dag_depth(node_id, depth) AS ('
+           'SELECT %(node)s, 0 '
+           'UNION '
+           'SELECT e.%(parent)s, d.depth + 1 FROM %(table)s e '
+           'INNER JOIN dag_depth d ON e.%(child)s = d.node_id'
+           ') ' + select)
+    return sql % {
+        'table': table,
+        'parent': parent,
+        'child': child,
+        'node': node_column,
+    }
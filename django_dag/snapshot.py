@@ -0,0 +1,284 @@
+"""
+In memory snapshot of a graph, to run many traversals without queries.
+"""
+
+from array import array
+from collections import deque
+
+from .graph import postorder
+from .models import NodeNotReachableException, _edge_pk_pairs
+from .query import SubquerySQL, component_sql
+
+
+class DagSnapshot(object):
+    """
+    Compressed (CSR) adjacency of a set of edges: node primary keys are
+    mapped to consecutive indexes and the children of the node at index i
+    are child_targets[child_offsets[i]:child_offsets[i + 1]], the same
+    goes for parents.
+
+    Methods take nodes or primary keys and mirror NodeBase; they run
+    without queries, except for loading the model instances they return
+    the first time they are needed.
+    """
+
+    def __init__(self, node_model, pairs, pks=(), instances=None):
+        self.node_model = node_model
+        self.pks = []
+        self.index = {}
+        pairs = list(pairs)
+        for pk in list(pks) + [pk for pair in pairs for pk in pair]:
+            if pk not in self.index:
+                self.index[pk] = len(self.pks)
+                self.pks.append(pk)
+        edges = [(self.index[p], self.index[c]) for p, c in pairs]
+        self.child_offsets, self.child_targets = self._compress(edges)
+        self.parent_offsets, self.parent_targets = self._compress([(c, p) for p, c in edges])
+        self._instances = dict(instances or {})
+
+    def _compress(self, edges):
+        offsets = array('l', [0] * (len(self.pks) + 1))
+        for source, target in edges:
+            offsets[source + 1] += 1
+        for i in range(len(self.pks)):
+            offsets[i + 1] += offsets[i]
+        targets = array('l', [0] * len(edges))
+        position = array('l', offsets)
+        for source, target in edges:
+            targets[position[source]] = target
+            position[source] += 1
+        return offsets, targets
+
+    @classmethod
+    def load(cls, node_model, nodes=False):
+        """
+        Snapshot of the whole edge table, nodes loads all the model
+        instances as well
+        """
+        pairs = _edge_pk_pairs(node_model.children.through)
+        instances = node_model.objects.in_bulk() if nodes else None
+        return cls(node_model, pairs, instances=instances)
+
+    @classmethod
+    def component(cls, node, nodes=False):
+        """
+        Snapshot of the connected component of node, nodes loads all the
+        model instances as well
+        """
+        node_model = node.__class__
+        edges = node_model.children.through.objects
+        if node_model._dag_cte_enabled():
+            parent_field = node_model._dag_edge_fields()[0]
+            to_field = parent_field.target_field.attname
+            sql, params = component_sql(node_model.children.through,
+                                        node_model._dag_connection(), getattr(node, to_field))
+            pairs = edges.filter(**{'%s__in' % parent_field.attname: SubquerySQL(sql, params)})
+            pairs = pairs.values_list('parent__pk', 'child__pk')
+        else:
+            # One query per level and direction
+            pairs = set()
+            seen = set([node.pk])
+            frontier = seen
+            while frontier:
+                found = set()
+                for pk, child in node_model._dag_adjacency(frontier):
+                    pairs.add((pk, child))
+                    found.add(child)
+                for pk, parent in node_model._dag_adjacency(frontier, reverse=True):
+                    pairs.add((parent, pk))
+                    found.add(parent)
+                frontier = found - seen
+                seen.update(frontier)
+        snapshot = cls(node_model, pairs, pks=[node.pk], instances={node.pk: node})
+        if nodes:
+            snapshot.nodes(snapshot.pks)
+        return snapshot
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __contains__(self, node):
+        return getattr(node, 'pk', node) in self.index
+
+    def nodes(self, pks):
+        """
+        Returns the model instances of the primary keys, the missing ones
+        are loaded in one query
+        """
+        pks = list(pks)
+        missing = [pk for pk in pks if pk not in self._instances]
+        if missing:
+            self._instances.update(self.node_model.objects.in_bulk(missing))
+        return [self._instances[pk] for pk in pks]
+
+    def _position(self, node):
+        return self.index[getattr(node, 'pk', node)]
+
+    def _children(self, i):
+        return self.child_targets[self.child_offsets[i]:self.child_offsets[i + 1]]
+
+    def _parents(self, i):
+        return self.parent_targets[self.parent_offsets[i]:self.parent_offsets[i + 1]]
+
+    def _walk(self, start, reverse=False):
+        """
+        Returns the indexes reachable from start, breadth first
+        """
+        offsets, targets = ((self.parent_offsets, self.parent_targets) if reverse
+                            else (self.child_offsets, self.child_targets))
+        seen = bytearray(len(self.pks))
+        seen[start] = 1
+        queue = deque([start])
+        result = []
+        while queue:
+            i = queue.popleft()
+            for j in targets[offsets[i]:offsets[i + 1]]:
+                if not seen[j]:
+                    seen[j] = 1
+                    result.append(j)
+                    queue.append(j)
+        return result
+
+    def children_ids(self, node):
+        return set(self.pks[j] for j in self._children(self._position(node)))
+
+    def parents_ids(self, node):
+        return set(self.pks[j] for j in self._parents(self._position(node)))
+
+    def descendants_ids(self, node):
+        return set(self.pks[j] for j in self._walk(self._position(node)))
+
+    def ancestors_ids(self, node):
+        return set(self.pks[j] for j in self._walk(self._position(node), reverse=True))
+
+    def descendants_set(self, node):
+        """
+        Returns a set of descendants
+        """
+        return set(self.nodes(self.descendants_ids(node)))
+
+    def ancestors_set(self, node):
+        """
+        Returns a set of ancestors
+        """
+        return set(self.nodes(self.ancestors_ids(node)))
+
+    def descendants_edges_set(self, node):
+        """
+        Returns a set of descendants edges, as (parent, child) primary keys
+        """
+        start = self._position(node)
+        return set((self.pks[i], self.pks[j])
+                   for i in [start] + self._walk(start) for j in self._children(i))
+
+    def ancestors_edges_set(self, node):
+        """
+        Returns a set of ancestors edges, as (parent, child) primary keys
+        """
+        start = self._position(node)
+        return set((self.pks[j], self.pks[i])
+                   for i in [start] + self._walk(start, reverse=True) for j in self._parents(i))
+
+    def is_ancestor_of(self, node, other):
+        return self._position(other) in set(self._walk(self._position(node)))
+
+    def is_root(self, node):
+        i = self._position(node)
+        return bool(len(self._children(i)) and not len(self._parents(i)))
+
+    def is_leaf(self, node):
+        i = self._position(node)
+        return bool(len(self._parents(i)) and not len(self._children(i)))
+
+    def is_island(self, node):
+        i = self._position(node)
+        return not len(self._children(i)) and not len(self._parents(i))
+
+    def get_roots(self, node):
+        """
+        Returns the ancestors without parents
+        """
+        return set(self.nodes(self.pks[j] for j in self._walk(self._position(node), reverse=True)
+                              if not len(self._parents(j))))
+
+    def get_leaves(self, node):
+        """
+        Returns the descendants without children
+        """
+        return set(self.nodes(self.pks[j] for j in self._walk(self._position(node))
+                              if not len(self._children(j))))
+
+    def roots(self):
+        """
+        Returns all the nodes with children and without parents
+        """
+        return set(self.nodes(pk for pk in self.pks if self.is_root(pk)))
+
+    def leaves(self):
+        """
+        Returns all the nodes with parents and without children
+        """
+        return set(self.nodes(pk for pk in self.pks if self.is_leaf(pk)))
+
+    def _tree(self, node, reverse=False):
+        """
+        Returns the nested dicts of descendants (ancestors if reverse),
+        nodes reachable through many paths share the same dict
+        """
+        start = self._position(node)
+        links = self._parents if reverse else self._children
+        reached = [start] + self._walk(start, reverse)
+        adjacency = dict((i, list(links(i))) for i in reached)
+        instances = dict(zip(reached, self.nodes(self.pks[i] for i in reached)))
+        trees = {}
+        for i in postorder(adjacency):
+            trees[i] = dict((instances[j], trees[j]) for j in adjacency[i])
+        return trees[start]
+
+    def descendants_tree(self, node):
+        """
+        Returns a tree-like structure with progeny
+        """
+        return self._tree(node)
+
+    def ancestors_tree(self, node):
+        """
+        Returns a tree-like structure with ancestors
+        """
+        return self._tree(node, reverse=True)
+
+    def _path(self, node, target, max_depth=None):
+        start, end = self._position(node), self._position(target)
+        if start == end:
+            return []
+        preds = {start: None}
+        frontier = [start]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            depth += 1
+            found = []
+            for i in frontier:
+                for j in self._children(i):
+                    if j not in preds:
+                        preds[j] = i
+                        found.append(j)
+            if end in preds:
+                path = []
+                while end != start:
+                    path.append(self.pks[end])
+                    end = preds[end]
+                return path[::-1]
+            frontier = found
+        raise NodeNotReachableException
+
+    def path(self, node, target, max_depth=None):
+        """
+        Returns the shortest path
+        """
+        return self.nodes(self._path(node, target, max_depth))
+
+    def distance(self, node, target, max_depth=None):
+        """
+        Returns the shortest hops count to the target vertex
+        """
+        return len(self._path(node, target, max_depth))
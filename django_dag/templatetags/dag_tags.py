@@ -2,79 +2,175 @@
 # from http://djangosnippets.org/snippets/1974/
 
 from django import template
+from django.utils.encoding import force_str
 
 register = template.Library()
 
 
+def dict_items(value):
+    """
+    Returns the (key, value) items nested in a value of a dict, None for
+    a leaf value
+    """
+    if type(value) == list or type(value) == tuple:
+        return [(None, x) for x in value]
+    try:
+        return value.items()
+    except AttributeError:
+        return None
+
+
 class RecurseDictNode(template.Node):
-    def __init__(self, var, nodeList):
+    """
+    Renders nested dicts without recursion: the levels being rendered are
+    kept on a stack and the output goes to a single list.
+
+    With cache, the output of a nested dict is rendered once per level
+    and reused wherever the same dict shows up again, as the shared
+    subtrees of descendants_tree(): the blocks must then depend only on
+    the nested dict and on the level.
+    """
+
+    def __init__(self, var, nodeList, cache=False):
         self.var = var
         self.nodeList = nodeList
+        self.cache = cache
 
     def __repr__(self):
         return '<RecurseDictNode>'
 
-    def renderCallback(self, context, vals, level):
-        if len(vals) == 0:
-            return ''
+    def fragment_key(self, value, level):
+        return (id(value), level)
 
+    def renderItems(self, context, value, items, level, children):
+        """
+        Renders the items of value at level, children returns the items
+        nested in a value or None for a leaf. Nodes are shared by the
+        threads rendering a template: the state of the render stays local.
+        """
+        nodeList = self.nodeList
         output = []
-
-        if 'loop' in self.nodeList:
-            output.append(self.nodeList['loop'].render(context))
-
-        for k, v in vals:
+        fragments = {}
+        stack = []
+
+        def open_level(value, items, level):
+            if self.cache:
+                key = self.fragment_key(value, level)
+                if key in fragments:
+                    output.append(fragments[key])
+                    return
+                stack.append(('store', key, len(output)))
+            items = list(items)
+            if not items:
+                return
+            if 'loop' in nodeList:
+                output.append(nodeList['loop'].render(context))
             context.push()
+            stack.append(('end', None, None))
+            stack.append(('items', iter(items), level))
+
+        open_level(value, items, level)
+        while stack:
+            kind, state, arg = stack[-1]
+            if kind == 'items':
+                for key, value in state:
+                    break
+                else:
+                    stack.pop()
+                    continue
+                context['level'] = arg
+                context['key'] = key
+                stack.append(('close', None, None))
+                if 'value' in nodeList:
+                    output.append(nodeList['value'].render(context))
+                    items = children(value)
+                    if items is None:
+                        output.append(force_str(value))
+                    else:
+                        open_level(value, items, arg + 1)
+            elif kind == 'close':
+                stack.pop()
+                if 'endloop' in nodeList:
+                    output.append(nodeList['endloop'].render(context))
+                else:
+                    output.append(nodeList['endrecursedict'].render(context))
+            elif kind == 'end':
+                stack.pop()
+                context.pop()
+                if 'endloop' in nodeList:
+                    output.append(nodeList['endrecursedict'].render(context))
+            else:
+                stack.pop()
+                fragment = ''.join(output[arg:])
+                output[arg:] = [fragment]
+                fragments[state] = fragment
+        return ''.join(output)
 
-            context['level'] = level
-            context['key'] = k
+    def render(self, context):
+        value = self.var.resolve(context)
+        return self.renderItems(context, value, value.items(), 1, dict_items)
 
-            if 'value' in self.nodeList:
-                output.append(self.nodeList['value'].render(context))
 
-                if type(v) == list or type(v) == tuple:
-                    child_items = [ (None, x) for x in v ]
-                    output.append(self.renderCallback(context, child_items, level + 1))
-                else:
-                    try:
-                        child_items = v.items()
-                        output.append(self.renderCallback(context, child_items, level + 1))
-                    except:
-                        output.append(unicode(v))
-
-            if 'endloop' in self.nodeList:
-                output.append(self.nodeList['endloop'].render(context))
-            else:
-                output.append(self.nodeList['endrecursedict'].render(context))
+class RecurseDagNode(RecurseDictNode):
+    """
+    Renders the descendants, or the ancestors, of a node as recursedict
+    renders its descendants_tree(), from a single fetch of the edges
+    """
 
-            context.pop()
+    def __init__(self, var, nodeList, cache=False, ancestors=False):
+        super(RecurseDagNode, self).__init__(var, nodeList, cache)
+        self.ancestors = ancestors
 
-        if 'endloop' in self.nodeList:
-            output.append(self.nodeList['endrecursedict'].render(context))
+    def __repr__(self):
+        return '<RecurseDagNode>'
 
-        return ''.join(output)
+    def fragment_key(self, node, level):
+        return (node.pk, level)
 
     def render(self, context):
-        vals = self.var.resolve(context).items()
-        output = self.renderCallback(context, vals, 1)
-        return output
+        node = self.var.resolve(context)
+        if self.ancestors:
+            links = node.ancestors_tree(flat=True)
+        else:
+            links = node.descendants_tree(flat=True)
 
+        def children(node):
+            return [(n, n) for n in links[node]]
+        return self.renderItems(context, node, children(node), 1, children)
 
-def recursedict_tag(parser, token):
-    bits = list(token.split_contents())
-    if len(bits) != 2 and bits[0] != 'recursedict':
-        raise template.TemplateSyntaxError("Invalid tag syntax expected '{% recursedict [dictVar] %}'")
 
-    var = parser.compile_filter(bits[1])
+def parse_blocks(parser, end):
     nodeList = {}
     while len(nodeList) < 4:
-        temp = parser.parse(('value','loop','endloop','endrecursedict'))
+        temp = parser.parse(('value', 'loop', 'endloop', end))
         tag = parser.tokens[0].contents
-        nodeList[tag] = temp
+        nodeList['endrecursedict' if tag == end else tag] = temp
         parser.delete_first_token()
-        if tag == 'endrecursedict':
+        if tag == end:
             break
+    return nodeList
+
+
+def recursedict_tag(parser, token):
+    bits = list(token.split_contents())
+    if len(bits) not in (2, 3) or (len(bits) == 3 and bits[2] != 'cache'):
+        raise template.TemplateSyntaxError("Invalid tag syntax expected '{% recursedict [dictVar] [cache] %}'")
 
-    return RecurseDictNode(var, nodeList)
+    var = parser.compile_filter(bits[1])
+    return RecurseDictNode(var, parse_blocks(parser, 'endrecursedict'), cache=len(bits) == 3)
 
 recursedict_tag = register.tag('recursedict', recursedict_tag)
+
+
+def recursedag_tag(parser, token):
+    bits = list(token.split_contents())
+    options = bits[2:]
+    if len(bits) < 2 or any(o not in ('ancestors', 'cache') for o in options):
+        raise template.TemplateSyntaxError(
+            "Invalid tag syntax expected '{% recursedag [node] [ancestors] [cache] %}'")
+
+    var = parser.compile_filter(bits[1])
+    return RecurseDagNode(var, parse_blocks(parser, 'endrecursedag'),
+                          cache='cache' in options, ancestors='ancestors' in options)
+
+recursedag_tag = register.tag('recursedag', recursedag_tag)
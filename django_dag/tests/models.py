@@ -1,13 +1,16 @@
 
-from django.db.models import CharField
-from django_dag.models import node_factory, edge_factory
+from django.db.models import CASCADE, CharField, ForeignKey, IntegerField, Model
+from django_dag.models import node_factory, edge_factory, closure_factory, reachability_factory
 
 
 class ConcreteNode(node_factory('ConcreteEdge')):
     """
-    Test node, adds just one field
+    Test node, adds a name and a level field, layer
     """
     name = CharField(max_length=32)
+    layer = IntegerField(default=0)
+
+    dag_level_field = 'layer'
 
     def __str__(self):
         return '# %s' % self.name
@@ -26,3 +29,84 @@ class ConcreteEdge(edge_factory('ConcreteNode', concrete=False)):
         app_label = 'django_dag'
 
 
+class ClosureNode(node_factory('ClosureEdge')):
+    """
+    Test node with a transitive closure model
+    """
+    name = CharField(max_length=32)
+
+    def __str__(self):
+        return '# %s' % self.name
+
+    class Meta:
+        app_label = 'django_dag'
+
+
+class ClosureEdge(edge_factory('ClosureNode', concrete=False)):
+    """
+    Test edge for ClosureNode
+    """
+    class Meta:
+        app_label = 'django_dag'
+
+
+class ConcreteClosure(closure_factory('ClosureNode', 'ClosureEdge', concrete=False)):
+    """
+    Test transitive closure for ClosureNode
+    """
+    class Meta:
+        app_label = 'django_dag'
+
+
+class CountedNode(node_factory('CountedEdge', denormalize=True)):
+    """
+    Test node with denormalized counts and depths
+    """
+    name = CharField(max_length=32)
+
+    class Meta:
+        app_label = 'django_dag'
+
+
+class CountedEdge(edge_factory('CountedNode', concrete=False)):
+    """
+    Test edge for CountedNode
+    """
+    class Meta:
+        app_label = 'django_dag'
+
+
+class IndexedNode(node_factory('IndexedEdge')):
+    """
+    Test node with a reachability index
+    """
+    name = CharField(max_length=32)
+
+    class Meta:
+        app_label = 'django_dag'
+
+
+class IndexedEdge(edge_factory('IndexedNode', concrete=False)):
+    """
+    Test edge for IndexedNode
+    """
+    class Meta:
+        app_label = 'django_dag'
+
+
+class ConcreteReachability(reachability_factory('IndexedNode', 'IndexedEdge', concrete=False)):
+    """
+    Test reachability index for IndexedNode
+    """
+    class Meta:
+        app_label = 'django_dag'
+
+
+class ClosureEdgeNote(Model):
+    """
+    Test model pointing to ClosureEdge, cascaded when edges are removed
+    """
+    edge = ForeignKey(ClosureEdge, on_delete=CASCADE)
+
+    class Meta:
+        app_label = 'django_dag'
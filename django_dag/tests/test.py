@@ -1,10 +1,25 @@
 import multiprocessing
+import random
+import unittest
+from io import BytesIO, StringIO
 
-from django.test import TestCase
+from django.db import connection, connections, DatabaseError
+from django.db.models.signals import post_delete
+from django.test import TestCase, TransactionTestCase
 from django.shortcuts import render_to_response
+from django.template import Context, Template, TemplateSyntaxError
 from django.core.exceptions import ValidationError
+from django.core.management import call_command, CommandError
+from django.core.cache import caches
+from django_dag.graph import topological_sort
+from django_dag.models import NodeNotReachableException
+from django_dag.snapshot import DagSnapshot
+from django_dag import benchmark, transfer
+from django_dag.instrument import traversal_done, record_traversals, log_traversal
+from django_dag.cache import LRUCache, DjangoCache, enable_cache, disable_cache
 from django_dag.tree_test_output import expected_tree_output
-from .models import ConcreteNode, ConcreteEdge
+from .models import ConcreteNode, ConcreteEdge, ClosureNode, ClosureEdge, ConcreteClosure, CountedNode, CountedEdge
+from .models import IndexedNode, IndexedEdge, ConcreteReachability, ClosureEdgeNote
 
 
 
@@ -167,3 +182,932 @@ class DagTestCase(TestCase):
             p.terminate()
             p.join()
             raise RuntimeError('Graph operations take too long!')
+
+    def test_04_closure_queries(self):
+        # 1 -> 2 -> 3 -> 4, 1 -> 3, 5 -> 3
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 6))
+        p[1].add_child(p[2])
+        p[2].add_child(p[3])
+        p[3].add_child(p[4])
+        p[1].add_child(p[3])
+        p[5].add_child(p[3])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(n.pk for n in p[1].descendants()), [2, 3, 4])
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(n.pk for n in p[4].ancestors_set()), [1, 2, 3, 5])
+        # The QuerySet composes with other filters
+        self.assertEqual(list(p[4].ancestors().filter(name='5')), [p[5]])
+
+        ConcreteNode.dag_backend = 'python'
+        try:
+            self.assertEqual(sorted(n.pk for n in p[1].descendants()), [2, 3, 4])
+            self.assertEqual(sorted(n.pk for n in p[4].ancestors_set()), [1, 2, 3, 5])
+        finally:
+            ConcreteNode.dag_backend = None
+
+    def test_05_reachability(self):
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 6))
+        p[1].add_child(p[2])
+        p[2].add_child(p[3])
+        p[1].add_child(p[3])
+        p[4].add_child(p[3])
+
+        for backend in (None, 'python'):
+            ConcreteNode.dag_backend = backend
+            try:
+                self.assertTrue(p[1].is_ancestor_of(p[3]))
+                self.assertTrue(p[3].is_descendant_of(p[1]))
+                self.assertFalse(p[3].is_ancestor_of(p[1]))
+                self.assertFalse(p[4].is_ancestor_of(p[2]))
+                self.assertFalse(p[1].is_ancestor_of(p[5]))
+                self.assertFalse(p[1].is_ancestor_of(p[1]))
+            finally:
+                ConcreteNode.dag_backend = None
+
+        with self.assertNumQueries(1):
+            self.assertTrue(p[1].is_ancestor_of(p[3]))
+        # The check of a new edge runs one query before the insert
+        with self.assertNumQueries(2):
+            p[5].add_child(p[1])
+        self.assertRaises(ValidationError, p[3].add_child, p[5])
+
+    def test_06_bulk_add_edges(self):
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 11))
+        p[1].add_child(p[2])
+        ConcreteNode.bulk_add_edges([(p[2], p[3]), (3, 4), (p[1], p[4])], name='bulk')
+        self.assertEqual(sorted(n.pk for n in p[1].descendants()), [2, 3, 4])
+        self.assertEqual(ConcreteEdge.objects.filter(name='bulk').count(), 3)
+
+        # All the offending edges are reported and nothing is written
+        try:
+            ConcreteEdge.bulk_add_edges([(4, 1), (5, 6), (6, 5), (7, 7), (8, 9), (3, 2)])
+        except ValidationError as e:
+            offending = sorted((error.params['parent'], error.params['child']) for error in e.error_list)
+            self.assertEqual(offending, [(3, 2), (4, 1), (5, 6), (6, 5), (7, 7)])
+        else:
+            self.fail('Cycles not detected')
+        self.assertEqual(ConcreteEdge.objects.count(), 4)
+
+    def test_07_shortest_paths(self):
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 11))
+        # Two diamonds in a row: 1 -> (2, 3) -> 4 -> (5, 6) -> 7, plus 1 -> 8 -> 9 -> 10 -> 7
+        ConcreteNode.bulk_add_edges([(1, 2), (1, 3), (2, 4), (3, 4), (4, 5), (4, 6),
+                                     (5, 7), (6, 7), (1, 8), (8, 9), (9, 10), (10, 7)])
+        for bidirectional in (True, False):
+            paths = p[1].all_shortest_paths(p[7], bidirectional=bidirectional)
+            self.assertEqual(sorted([n.pk for n in path] for path in paths),
+                             [[2, 4, 5, 7], [2, 4, 6, 7], [3, 4, 5, 7], [3, 4, 6, 7], [8, 9, 10, 7]])
+            self.assertEqual(p[1].distance(p[7], bidirectional=bidirectional), 4)
+            self.assertEqual([n.pk for n in p[1].path(p[7], bidirectional=bidirectional)], [8, 9, 10, 7])
+        self.assertEqual(p[1].distance(p[7], max_depth=4), 4)
+        self.assertRaises(NodeNotReachableException, p[1].distance, p[7], max_depth=3)
+        self.assertRaises(NodeNotReachableException, p[7].path, p[1])
+        self.assertEqual(p[4].all_shortest_paths(p[4]), [[]])
+
+        # The edges between the nodes and the nodes
+        with self.assertNumQueries(2):
+            p[1].path(p[7], bidirectional=False)
+        ConcreteNode.dag_backend = 'python'
+        try:
+            self.assertEqual([n.pk for n in p[1].path(p[7])], [8, 9, 10, 7])
+            # One query per level and one to load the nodes
+            with self.assertNumQueries(5):
+                p[1].path(p[7], bidirectional=False)
+        finally:
+            ConcreteNode.dag_backend = None
+
+    def test_08_snapshot(self):
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 11))
+        ConcreteNode.bulk_add_edges([(1, 2), (1, 3), (2, 4), (3, 4), (4, 5), (6, 4), (8, 9)])
+        for backend in (None, 'python'):
+            ConcreteNode.dag_backend = backend
+            try:
+                snapshot = DagSnapshot.component(p[4])
+            finally:
+                ConcreteNode.dag_backend = None
+            self.assertEqual(sorted(snapshot.pks), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(len(DagSnapshot.load(ConcreteNode)), 8)
+
+        # Edges and nodes
+        with self.assertNumQueries(2):
+            snapshot = DagSnapshot.component(p[3], nodes=True)
+        descendants, ancestors = p[1].descendants_set(), p[5].ancestors_set()
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshot.descendants_set(p[1]), descendants)
+            self.assertEqual(snapshot.ancestors_set(p[5]), ancestors)
+            self.assertEqual(snapshot.get_roots(p[5]), set([p[1], p[6]]))
+            self.assertEqual(snapshot.get_leaves(p[1]), set([p[5]]))
+            self.assertEqual(snapshot.roots(), set([p[1], p[6]]))
+            self.assertEqual(snapshot.distance(p[1], p[5]), 3)
+            self.assertEqual(len(snapshot.path(p[2], 5)), 2)
+            self.assertEqual(snapshot.descendants_edges_set(p[3]), set([(3, 4), (4, 5)]))
+            self.assertTrue(snapshot.is_ancestor_of(p[1], p[5]))
+            self.assertTrue(snapshot.is_root(p[6]))
+            self.assertTrue(snapshot.is_leaf(p[5]))
+            tree = snapshot.descendants_tree(p[1])
+            self.assertIs(tree[p[2]][p[4]], tree[p[3]][p[4]])
+            self.assertEqual(tree[p[2]][p[4]], {p[5]: {}})
+        self.assertRaises(NodeNotReachableException, snapshot.path, p[5], p[1])
+        self.assertRaises(NodeNotReachableException, snapshot.distance, p[1], p[5], max_depth=2)
+
+        # Instances are loaded on demand
+        snapshot = DagSnapshot.component(p[8])
+        self.assertNotIn(p[10], snapshot)
+        with self.assertNumQueries(1):
+            self.assertEqual(snapshot.descendants_set(p[8]), set([p[9]]))
+        self.assertEqual(len(DagSnapshot.component(p[10])), 1)
+
+    def test_09_cache(self):
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 11))
+        for cache in (LRUCache(), DjangoCache()):
+            enable_cache(ConcreteNode, cache)
+            try:
+                p[1].add_child(p[2])
+                p[2].add_child(p[3])
+                p[4].add_child(p[5])
+                self.assertEqual(p[1].descendants_set(), set([p[2], p[3]]))
+                self.assertEqual(p[5].get_roots(), set([p[4]]))
+                # Hits load the cached nodes only
+                with self.assertNumQueries(1):
+                    self.assertEqual(p[1].descendants_set(), set([p[2], p[3]]))
+                with self.assertNumQueries(0):
+                    self.assertTrue(p[1].is_ancestor_of(p[3]))
+
+                # Edges invalidate the nodes above and below them only
+                p[3].add_child(p[4])
+                self.assertIsNone(cache.get('django_dag:django_dag.concretenode:descendants:1'))
+                self.assertIsNone(cache.get('django_dag:django_dag.concretenode:roots:5'))
+                self.assertEqual(p[1].descendants_set(), set([p[2], p[3], p[4], p[5]]))
+                self.assertEqual(p[5].get_roots(), set([p[1]]))
+                p[6].descendants_set()
+                p[2].remove_child(p[3])
+                self.assertEqual(p[1].descendants_set(), set([p[2]]))
+                self.assertEqual(p[5].get_roots(), set([p[3]]))
+                self.assertIsNotNone(cache.get('django_dag:django_dag.concretenode:descendants:6'))
+
+                ConcreteNode.bulk_add_edges([(2, 3)])
+                self.assertEqual(p[1].descendants_set(), set([p[2], p[3], p[4], p[5]]))
+            finally:
+                disable_cache(ConcreteNode)
+                cache.clear()
+            ConcreteEdge.objects.all().delete()
+
+    def test_10_roots_and_leaves(self):
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 11))
+        ConcreteNode.bulk_add_edges([(1, 3), (2, 3), (3, 4), (3, 5), (4, 6), (7, 6), (8, 9)])
+        for backend in (None, 'python'):
+            ConcreteNode.dag_backend = backend
+            try:
+                self.assertEqual(p[6].get_roots(), set([p[1], p[2], p[7]]))
+                self.assertEqual(p[1].get_leaves(), set([p[5], p[6]]))
+                self.assertEqual(p[1].get_roots(), set())
+                self.assertEqual(p[10].get_leaves(), set())
+            finally:
+                ConcreteNode.dag_backend = None
+        with self.assertNumQueries(1):
+            p[6].get_roots()
+
+        self.assertEqual(sorted(n.pk for n in ConcreteNode.objects.roots()), [1, 2, 7, 8])
+        self.assertEqual(sorted(n.pk for n in ConcreteNode.objects.leaves()), [5, 6, 9])
+        self.assertEqual(list(ConcreteNode.objects.filter(pk__lt=5).leaves()), [])
+
+    def test_11_trees(self):
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 11))
+        ConcreteNode.bulk_add_edges([(1, 2), (1, 3), (2, 4), (3, 4), (4, 5), (5, 6), (4, 7)])
+        for backend in (None, 'python'):
+            ConcreteNode.dag_backend = backend
+            try:
+                tree = p[1].descendants_tree()
+            finally:
+                ConcreteNode.dag_backend = None
+            self.assertEqual(tree, {p[2]: {p[4]: {p[5]: {p[6]: {}}, p[7]: {}}},
+                                    p[3]: {p[4]: {p[5]: {p[6]: {}}, p[7]: {}}}})
+            # Shared sub-DAG
+            self.assertIs(tree[p[2]][p[4]], tree[p[3]][p[4]])
+
+        # Closure query with the edges, then the nodes
+        with self.assertNumQueries(2):
+            p[1].descendants_tree()
+        self.assertEqual(p[6].ancestors_tree(max_depth=2), {p[5]: {p[4]: {}}})
+        self.assertEqual(p[1].descendants_tree(max_depth=2), {p[2]: {p[4]: {}}, p[3]: {p[4]: {}}})
+        self.assertEqual(p[1].descendants_tree(max_nodes=3), {p[2]: {p[4]: {}}, p[3]: {p[4]: {}}})
+        self.assertEqual(p[4].descendants_tree(flat=True), {p[4]: [p[5], p[7]], p[5]: [p[6]],
+                                                            p[6]: [], p[7]: []})
+        flat = p[4].ancestors_tree(flat=True, max_depth=1)
+        self.assertEqual(set(flat[p[4]]), set([p[2], p[3]]))
+        self.assertEqual(flat[p[2]], [])
+
+    def test_12_queryset(self):
+        ConcreteNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4), (5, 4), (6, 7)])
+        nodes = ConcreteNode.objects
+        p1 = nodes.get(pk=1)
+        for backend in (None, 'python'):
+            ConcreteNode.dag_backend = backend
+            try:
+                self.assertEqual(sorted(n.pk for n in nodes.descendants_of(p1)), [2, 3, 4])
+                self.assertEqual(sorted(n.pk for n in nodes.descendants_of(nodes.filter(pk__in=[5, 6]))),
+                                 [4, 7])
+                self.assertEqual(sorted(n.pk for n in nodes.ancestors_of(nodes.filter(pk=4))), [1, 2, 3, 5])
+                self.assertEqual(list(nodes.ancestors_of(nodes.filter(pk=4)).filter(pk__gt=2)
+                                      .values_list('pk', flat=True).order_by('pk')), [3, 5])
+                self.assertEqual(sorted(n.pk for n in nodes.islands()), [8, 9, 10])
+                self.assertEqual(dict(nodes.annotate_depth().values_list('pk', 'depth')),
+                                 {1: 0, 2: 1, 3: 2, 4: 3, 5: 0, 6: 0, 7: 1, 8: 0, 9: 0, 10: 0})
+                self.assertEqual(dict(nodes.filter(pk__in=[3, 4]).annotate_depth('level', longest=False)
+                                      .values_list('pk', 'level')), {3: 1, 4: 1})
+            finally:
+                ConcreteNode.dag_backend = None
+        with self.assertNumQueries(1):
+            list(nodes.descendants_of(nodes.roots()).annotate_depth())
+
+    def test_13_reachable_maps(self):
+        ConcreteNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4), (5, 4), (6, 7)])
+        expected = {1: set([2, 3, 4]), 2: set([3, 4]), 5: set([4]), 6: set([7]), 8: set()}
+        for backend in (None, 'python'):
+            ConcreteNode.dag_backend = backend
+            try:
+                self.assertEqual(ConcreteNode.descendants_map([1, 2, 5, 6, 8]), expected)
+                self.assertEqual(ConcreteNode.ancestors_map(ConcreteNode.objects.filter(pk__in=[4, 7])),
+                                 {4: set([1, 2, 3, 5]), 7: set([6])})
+            finally:
+                ConcreteNode.dag_backend = None
+        # Closure and edges in one query
+        with self.assertNumQueries(1):
+            ConcreteNode.descendants_map([ConcreteNode(pk=1), 5])
+
+    def test_14_ids_only(self):
+        ConcreteNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4), (5, 4)])
+        p2, p3 = ConcreteNode.objects.get(pk=2), ConcreteNode.objects.get(pk=3)
+        for backend in (None, 'python'):
+            ConcreteNode.dag_backend = backend
+            try:
+                self.assertEqual(p3.descendants_set(ids_only=True), frozenset([4]))
+                self.assertEqual(p3.ancestors_set(ids_only=True), frozenset([1, 2]))
+                self.assertEqual(p3.nodes_set(ids_only=True), frozenset([1, 2, 3, 4]))
+                self.assertEqual(p2.descendants_edges_set(ids_only=True), frozenset([(2, 3), (3, 4)]))
+                self.assertEqual(p3.ancestors_edges_set(ids_only=True), frozenset([(1, 2), (2, 3), (1, 3)]))
+                self.assertEqual(p3.edges_set(ids_only=True),
+                                 frozenset([(1, 2), (2, 3), (1, 3), (3, 4)]))
+                self.assertEqual(set((a.pk, b.pk) for a, b in p3.edges_set()),
+                                 set([(1, 2), (2, 3), (1, 3), (3, 4)]))
+            finally:
+                ConcreteNode.dag_backend = None
+        with self.assertNumQueries(1):
+            p3.ancestors_set(ids_only=True)
+        with self.assertNumQueries(1):
+            p3.ancestors_edges_set(ids_only=True)
+
+    def test_15_iterators(self):
+        ConcreteNode.bulk_add_edges([(1, 2), (1, 3), (2, 4), (3, 4), (4, 5), (6, 5)])
+        p1, p5 = ConcreteNode.objects.get(pk=1), ConcreteNode.objects.get(pk=5)
+        bfs = [(n.pk, depth) for n, depth in p1.iter_descendants(with_depth=True)]
+        self.assertEqual(sorted(bfs[:2]), [(2, 1), (3, 1)])
+        self.assertEqual(bfs[2:], [(4, 2), (5, 3)])
+        dfs = [n.pk for n in p1.iter_descendants(order='dfs', chunk_size=1)]
+        self.assertEqual(sorted(dfs), [2, 3, 4, 5])
+        self.assertTrue(dfs.index(4) == dfs.index(5) - 1)
+        self.assertEqual(set(n.pk for n in p5.iter_ancestors(order='dfs')), set([1, 2, 3, 4, 6]))
+        self.assertEqual(set(p1.iter_edges(ids_only=True)), set([(1, 2), (1, 3), (2, 4), (3, 4), (4, 5)]))
+        self.assertEqual(set((a.pk, b.pk) for a, b in p5.iter_edges(ancestors=True, order='dfs')),
+                         set([(1, 2), (1, 3), (2, 4), (3, 4), (4, 5), (6, 5)]))
+        self.assertRaises(ValueError, p1.iter_descendants, order='random')
+        # Early termination: edges of the first level and one chunk of nodes
+        with self.assertNumQueries(2):
+            first = next(p1.iter_descendants(chunk_size=1))
+        self.assertIn(first.pk, (2, 3))
+
+    def test_16_topological_order(self):
+        ConcreteNode.bulk_add_edges([(1, 2), (1, 3), (2, 4), (3, 4), (4, 5), (6, 5), (1, 5)])
+        expected = {1: 0, 2: 1, 3: 1, 4: 2, 5: 3, 6: 0, 7: 0, 8: 0, 9: 0, 10: 0}
+        self.assertEqual(ConcreteNode.objects.levels(), expected)
+        # Edges, node ids and one chunk of nodes
+        with self.assertNumQueries(3):
+            order = [n.pk for n in ConcreteNode.objects.topological_order()]
+        self.assertEqual(order, [1, 6, 7, 8, 9, 10, 2, 3, 4, 5])
+        order = [n.pk for n in ConcreteNode.objects.filter(pk__lte=5).topological_order(chunk_size=2)]
+        self.assertEqual(order, [1, 2, 3, 4, 5])
+        p3 = ConcreteNode.objects.get(pk=3)
+        self.assertEqual(p3.levels(), {1: 0, 3: 1, 4: 2, 5: 3})
+        self.assertEqual([n.pk for n in p3.topological_order()], [1, 3, 4, 5])
+        ConcreteNode.objects.update_levels()
+        self.assertEqual(dict(ConcreteNode.objects.values_list('pk', 'layer')), expected)
+        self.assertEqual(list(ConcreteNode.objects.filter(pk__lte=5).order_by('layer', 'pk')
+                              .values_list('pk', flat=True)), [1, 2, 3, 4, 5])
+
+    def test_17_bulk_detach(self):
+        ConcreteNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4), (5, 4), (6, 7), (7, 8), (6, 9)])
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 11))
+        deleted = []
+        receiver = lambda sender, instance, **kwargs: deleted.append(instance)
+        post_delete.connect(receiver, sender=ConcreteEdge)
+        try:
+            # The edges are collected for the signals, then deleted
+            with self.assertNumQueries(2):
+                p[1].remove_child(p[3])
+            self.assertEqual(ConcreteNode.remove_edges([(3, 4)]), 1)
+        finally:
+            post_delete.disconnect(receiver, sender=ConcreteEdge)
+        self.assertEqual([(e.parent_id, e.child_id) for e in deleted], [(1, 3), (3, 4)])
+        p[3].add_child(p[4])
+        self.assertRaises(ConcreteEdge.DoesNotExist, p[1].remove_child, p[3])
+        self.assertRaises(ConcreteEdge.DoesNotExist, p[3].remove_parent, p[5])
+        self.assertEqual(ConcreteNode.remove_edges([(2, 3), (p[5], p[4]), (9, 10)]), 2)
+        self.assertEqual(sorted(n.pk for n in p[3].descendants_set()), [4])
+        self.assertEqual(p[3].ancestors_set(), set())
+        cache = enable_cache(ConcreteNode)
+        try:
+            self.assertEqual(sorted(n.pk for n in p[6].descendants_set()), [7, 8, 9])
+            # Savepoint, edges, cache invalidation (2), the edges collected
+            # for the signals and DELETE
+            with self.assertNumQueries(7):
+                self.assertEqual(p[6].detach_all_children(), 2)
+            self.assertEqual(p[6].descendants_set(), set())
+            self.assertEqual(p[4].detach_all_parents(), 1)
+            self.assertTrue(p[4].is_island())
+        finally:
+            disable_cache(ConcreteNode)
+        ConcreteNode.bulk_add_edges([(1, 3), (3, 4), (4, 5), (10, 5)])
+        self.assertEqual(p[3].delete_subgraph(), 3)
+        self.assertEqual(sorted(ConcreteNode.objects.values_list('pk', flat=True)), [1, 2, 6, 7, 8, 9, 10])
+        self.assertTrue(p[10].is_island())
+        self.assertEqual(ConcreteEdge.objects.count(), 2)
+
+    def test_18_locking(self):
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 5))
+        ConcreteNode.dag_locking = 'rows'
+        try:
+            p[1].add_child(p[2])
+            p[2].add_child(p[3])
+            self.assertRaises(ValidationError, p[3].add_child, p[1])
+            self.assertRaises(ValidationError, p[3].add_child, p[3])
+            p[3].add_child(p[1], disable_circular_check=True)
+            self.assertEqual(ConcreteEdge.objects.count(), 3)
+        finally:
+            ConcreteNode.dag_locking = None
+
+    @unittest.skipUnless(hasattr(ConcreteNode, 'adescendants_set'), 'Needs asgiref')
+    def test_19_async(self):
+        from asgiref.sync import async_to_sync
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 6))
+        async_to_sync(p[1].aadd_child)(p[2])
+        ConcreteNode.bulk_add_edges([(2, 3), (3, 4), (1, 4)])
+        for backend in (None, 'python'):
+            ConcreteNode.dag_backend = backend
+            try:
+                self.assertEqual(async_to_sync(p[1].adescendants_set)(), set([p[2], p[3], p[4]]))
+                self.assertEqual(async_to_sync(p[4].aancestors_set)(ids_only=True), frozenset([1, 2, 3]))
+                self.assertEqual(async_to_sync(p[2].apath)(p[4]), [p[3], p[4]])
+                self.assertEqual(async_to_sync(p[1].adistance)(p[4]), 1)
+            finally:
+                ConcreteNode.dag_backend = None
+        self.assertRaises(ValidationError, async_to_sync(p[4].aadd_child), p[1])
+
+    def test_20_benchmark(self):
+        self.assertEqual(benchmark.lattice(6), [(1, 3), (1, 4), (2, 3), (2, 4), (3, 5), (3, 6), (4, 5), (4, 6)])
+        self.assertEqual(len(benchmark.random_dag(10, edges=20)), 20)
+        for shape in sorted(benchmark.SHAPES):
+            results = benchmark.run(ConcreteNode, shape, 12)
+            self.assertEqual(len(results), 43)
+            self.assertTrue(all(r['queries'] > 0 for r in results if r['name'] != 'is_root'))
+        # The writes are rolled back
+        self.assertEqual(ConcreteNode.objects.count(), 12)
+        self.assertEqual(ConcreteEdge.objects.count(), len(benchmark.random_dag(12)))
+        self.assertIn('Edge.save', benchmark.format_results(results))
+
+    def test_21_instrumentation(self):
+        ConcreteNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4)])
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 6))
+        with record_traversals(sender=ConcreteNode) as calls:
+            p[1].descendants_set()
+            p[4].add_parent(p[5])
+            ConcreteNode.descendants_map([1, 2])
+        self.assertEqual([c.method for c in calls], ['descendants_set', 'add_parent', 'descendants_map'])
+        self.assertEqual((calls[0].queries, calls[0].nodes, calls[0].rows), (1, 3, 3))
+        self.assertEqual(calls[2].queries, 1)
+        self.assertEqual(calls[2].rows, 4)
+        ConcreteNode.dag_backend = 'python'
+        cache = enable_cache(ConcreteNode)
+        try:
+            with record_traversals() as calls:
+                p[1].descendants_set(ids_only=True)
+                p[1].descendants_set(ids_only=True)
+        finally:
+            disable_cache(ConcreteNode)
+            ConcreteNode.dag_backend = None
+        self.assertEqual((calls[0].cache_misses, calls[0].queries, calls[0].nodes, calls[0].rows), (1, 3, 4, 4))
+        self.assertEqual((calls[1].cache_hits, calls[1].queries), (1, 0))
+        traversal_done.connect(log_traversal)
+        try:
+            with self.assertLogs('django_dag', 'DEBUG') as logs:
+                p[1].is_ancestor_of(p[4])
+        finally:
+            traversal_done.disconnect(log_traversal)
+        self.assertIn('ConcreteNode.is_ancestor_of(1): 1 queries', logs.output[0])
+
+    def test_22_template_tags(self):
+        ConcreteNode.bulk_add_edges([(1, 2), (1, 3), (2, 4), (3, 4), (4, 5)])
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 6))
+        blocks = '[{% loop %}{{ level }}:{{ key.pk }}{% value %}{% endloop %}]'
+        tree = Template('{%% load dag_tags %%}{%% recursedict tree %%}%s{%% endrecursedict %%}' % blocks)
+        cached = Template('{%% load dag_tags %%}{%% recursedict tree cache %%}%s{%% endrecursedict %%}' % blocks)
+        dag = Template('{%% load dag_tags %%}{%% recursedag node cache %%}%s{%% endrecursedag %%}' % blocks)
+        expected = '[1:2[2:4[3:5]]1:3[2:4[3:5]]]'
+        self.assertEqual(tree.render(Context({'tree': p[1].descendants_tree()})), expected)
+        self.assertEqual(cached.render(Context({'tree': p[1].descendants_tree()})), expected)
+        with self.assertNumQueries(2):
+            self.assertEqual(dag.render(Context({'node': p[1]})), expected)
+        ancestors = Template('{% load dag_tags %}{% recursedag node ancestors %}'
+                             '{% loop %}{{ key.pk }}{% value %},{% endloop %}{% endrecursedag %}')
+        self.assertEqual(ancestors.render(Context({'node': p[5]})), '421,,31,,,')
+        self.assertRaises(TemplateSyntaxError, Template, '{% load dag_tags %}{% recursedag node sideways %}')
+
+    def test_23_common_ancestors(self):
+        ConcreteNode.bulk_add_edges([(1, 3), (2, 3), (3, 4), (3, 5), (1, 5), (6, 4), (6, 5)])
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 8))
+        pks = lambda nodes: [n.pk for n in nodes]
+        with self.assertNumQueries(2):
+            self.assertEqual(pks(p[4].common_ancestors(p[5])), [6, 3, 1, 2])
+        self.assertEqual(pks(p[4].lowest_common_ancestors(5)), [6, 3])
+        self.assertEqual(pks(p[3].lowest_common_ancestors(p[4], p[5])), [3])
+        self.assertEqual(pks(p[1].common_descendants(p[2])), [3, 5, 4])
+        self.assertEqual(pks(p[1].highest_common_descendants(p[2])), [3])
+        self.assertEqual(p[4].common_ancestors(p[7]), [])
+        ConcreteNode.dag_backend = 'python'
+        try:
+            self.assertEqual(pks(p[4].common_ancestors(p[5], p[3])), [3, 1, 2])
+        finally:
+            ConcreteNode.dag_backend = None
+
+    def test_24_export_import(self):
+        ConcreteNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4)])
+        ConcreteEdge.objects.filter(parent=1, child=2).update(name='first')
+        edges = sorted(ConcreteEdge.objects.values_list('parent', 'child', 'name'))
+        for format, stream in (('ndjson', StringIO()), ('csv', StringIO()), ('binary', BytesIO())):
+            self.assertEqual(transfer.export_edges(ConcreteNode, stream, format, chunk_size=3), 4)
+            ConcreteEdge.objects.all().delete()
+            stream.seek(0)
+            self.assertEqual(transfer.import_edges(ConcreteNode, stream, format, chunk_size=3), 4)
+            expected = edges if format != 'binary' else [(p, c, None) for p, c, name in edges]
+            self.assertEqual(sorted(ConcreteEdge.objects.values_list('parent', 'child', 'name')), expected)
+
+        # Names as keys, into another model creating the nodes
+        stream = StringIO()
+        transfer.export_edges(ConcreteNode, stream, 'csv', key='name')
+        stream.seek(0)
+        transfer.import_edges(CountedNode, stream, 'csv', key='name', create_missing=True)
+        node = CountedNode.objects.get(name='3')
+        self.assertEqual((node.parent_count, node.max_depth), (2, 2))
+        self.assertEqual(sorted(n.name for n in node.ancestors()), ['1', '2'])
+
+        stream = StringIO('{"parent": 4, "child": 5}\n{"parent": 5, "child": 1}\n')
+        with self.assertRaises(ValidationError) as error:
+            transfer.import_edges(ConcreteNode, stream)
+        self.assertEqual(len(error.exception.messages), 6)
+        self.assertEqual(ConcreteEdge.objects.count(), 4)
+        self.assertRaises(ValidationError, transfer.import_edges, ConcreteNode,
+                          StringIO('{"parent": 4, "child": 99}\n'))
+
+        # Binary edge lists hold integer keys, nothing is written otherwise
+        stream = BytesIO()
+        self.assertRaises(ValueError, transfer.export_edges, ConcreteNode, stream, 'binary', key='name')
+        self.assertEqual(stream.getvalue(), b'')
+        self.assertRaises(CommandError, call_command, 'dag_export', 'django_dag.ConcreteNode',
+                          '--format', 'binary', '--key', 'name', stdout=StringIO(), stderr=StringIO())
+
+        output = StringIO()
+        call_command('dag_export', 'django_dag.ConcreteNode', stdout=output, stderr=StringIO())
+        self.assertEqual(len(output.getvalue().splitlines()), 4)
+
+    def test_25_import_with_cache(self):
+        p = dict((i, ConcreteNode.objects.get(pk=i)) for i in range(1, 11))
+        shared = caches['default']
+        for cache in (LRUCache(), DjangoCache()):
+            enable_cache(ConcreteNode, cache)
+            try:
+                ConcreteNode.bulk_add_edges([(1, 2)])
+                shared.set('unrelated', 'kept')
+                cache.set('django_dag:django_dag.countednode:descendants:1', [2])
+                self.assertEqual(p[1].descendants_set(), set([p[2]]))
+                transfer.import_edges(ConcreteNode, StringIO('{"parent": 2, "child": 3}\n'))
+                self.assertEqual(p[1].descendants_set(), set([p[2], p[3]]))
+                # Only the entries of the imported model are dropped
+                self.assertEqual(shared.get('unrelated'), 'kept')
+                self.assertEqual(cache.get('django_dag:django_dag.countednode:descendants:1'), [2])
+            finally:
+                disable_cache(ConcreteNode)
+                shared.clear()
+                cache.clear()
+            ConcreteEdge.objects.all().delete()
+
+
+class DeepDagTestCase(TestCase):
+    """
+    Chains far deeper than the recursion limit
+    """
+
+    def chain(self, n):
+        ConcreteNode.objects.bulk_create([ConcreteNode(pk=i, name='%s' % i) for i in range(1, n + 1)])
+        ConcreteNode.bulk_add_edges([(i, i + 1) for i in range(1, n)])
+        return ConcreteNode.objects.get(pk=1), ConcreteNode.objects.get(pk=n)
+
+    def test_01_long_chain(self):
+        n = 100000
+        first, last = self.chain(n)
+        self.assertEqual(len(first.descendants_set(ids_only=True)), n - 1)
+        self.assertEqual(len(last.ancestors_set()), n - 1)
+        self.assertEqual(len(first.descendants_edges_set(ids_only=True)), n - 1)
+        self.assertTrue(first.is_ancestor_of(last))
+        self.assertEqual(first.get_leaves(), set([last]))
+        self.assertEqual(last.get_roots(), set([first]))
+        self.assertEqual(first.distance(last), n - 1)
+        self.assertEqual([node.pk for node in first.path(last)], list(range(2, n + 1)))
+        self.assertEqual(last.levels()[last.pk], n - 1)
+        tree, depth = first.descendants_tree(), 0
+        while tree:
+            (node, tree), = tree.items()
+            depth += 1
+        self.assertEqual((node, depth), (last, n - 1))
+
+    def test_02_python_backend(self):
+        n = 3000
+        first, last = self.chain(n)
+        ConcreteNode.dag_backend = 'python'
+        try:
+            self.assertEqual(len(first.descendants_set()), n - 1)
+            self.assertEqual(len(last.ancestors_set(cached_results={})), n - 1)
+            self.assertEqual(len(last.ancestors_edges_set()), n - 1)
+            self.assertEqual(len(first.path(last)), n - 1)
+            self.assertTrue(first.is_ancestor_of(last))
+        finally:
+            ConcreteNode.dag_backend = None
+
+
+def add_random_edges(locking, seed, count):
+    """
+    Adds random edges among the first 20 nodes, run in worker processes
+    """
+    connections.close_all()
+    ConcreteNode.dag_locking = locking
+    rng = random.Random(seed)
+    for i in range(count):
+        parent, child = rng.sample(range(1, 21), 2)
+        try:
+            ConcreteNode.objects.get(pk=parent).add_child(ConcreteNode.objects.get(pk=child))
+        except (ValidationError, DatabaseError):
+            # Cycles and deadlocks are rejected
+            pass
+    connections.close_all()
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'Needs concurrent transactions')
+class LockingTestCase(TransactionTestCase):
+
+    def setUp(self):
+        for i in range(1, 21):
+            ConcreteNode(name="%s" % i).save()
+
+    def hammer(self, locking, processes=8, count=50):
+        connections.close_all()
+        workers = [multiprocessing.Process(target=add_random_edges, args=(locking, seed, count))
+                   for seed in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(120)
+        self.assertTrue(all(worker.exitcode == 0 for worker in workers))
+        order, cyclic = topological_sort(ConcreteNode._dag_graph())
+        self.assertEqual(cyclic, [])
+        self.assertTrue(order)
+
+    def test_01_rows(self):
+        self.hammer('rows')
+
+    def test_02_advisory(self):
+        self.hammer('advisory')
+
+
+class ClosureTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(1, 8):
+            ClosureNode(name="%s" % i).save()
+        self.p = dict((i, ClosureNode.objects.get(pk=i)) for i in range(1, 8))
+
+    def closure_rows(self):
+        return sorted(ConcreteClosure.objects.values_list('ancestor', 'descendant', 'depth'))
+
+    def assertClosureConsistent(self):
+        rows = self.closure_rows()
+        ConcreteClosure.rebuild()
+        self.assertEqual(rows, self.closure_rows())
+
+    def test_01_closure_maintenance(self):
+        p = self.p
+        # Diamond 1 -> (2, 3) -> 4 -> 5, plus 1 -> 4 and 6 -> 2
+        p[1].add_child(p[2])
+        p[1].add_child(p[3])
+        p[2].add_child(p[4])
+        p[3].add_child(p[4])
+        p[4].add_child(p[5])
+        p[1].add_child(p[4])
+        p[6].add_child(p[2])
+        self.assertClosureConsistent()
+        self.assertEqual(
+            sorted(ConcreteClosure.objects.filter(ancestor=p[1], descendant=p[5]).values_list('depth', flat=True)),
+            [2, 3])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(n.pk for n in p[1].descendants_set()), [2, 3, 4, 5])
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(n.pk for n in p[5].ancestors()), [1, 2, 3, 4, 6])
+        self.assertEqual(p[1].distance(p[5]), 2)
+        self.assertEqual(p[6].distance(p[5]), 3)
+        self.assertRaises(NodeNotReachableException, p[5].distance, p[1])
+        self.assertRaises(ValidationError, p[5].add_child, p[6])
+        self.assertTrue(p[6].is_ancestor_of(p[5]))
+        self.assertFalse(p[3].is_ancestor_of(p[2]))
+
+        p[1].remove_child(p[4])
+        self.assertClosureConsistent()
+        self.assertEqual(p[1].distance(p[5]), 3)
+
+        # Cascades from node deletion
+        p[4].delete()
+        self.assertClosureConsistent()
+        self.assertEqual(sorted(n.pk for n in p[1].descendants()), [2, 3])
+        self.assertFalse(ConcreteClosure.objects.filter(descendant=p[5]).exists())
+
+    def test_02_queryset(self):
+        ClosureNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4), (5, 4), (6, 7)])
+        nodes = ClosureNode.objects
+        self.assertEqual(sorted(n.pk for n in nodes.descendants_of(nodes.filter(pk__in=[2, 6]))), [3, 4, 7])
+        self.assertEqual(sorted(n.pk for n in nodes.ancestors_of(self.p[4])), [1, 2, 3, 5])
+        self.assertEqual(dict(nodes.annotate_depth().values_list('pk', 'depth')),
+                         {1: 0, 2: 1, 3: 2, 4: 3, 5: 0, 6: 0, 7: 1})
+        self.assertEqual(dict(nodes.annotate_depth(longest=False).values_list('pk', 'depth')),
+                         {1: 0, 2: 1, 3: 1, 4: 1, 5: 0, 6: 0, 7: 1})
+        self.assertEqual(ClosureNode.ancestors_map([4, 7]), {4: set([1, 2, 3, 5]), 7: set([6])})
+
+    def test_03_bulk_add_edges(self):
+        p = self.p
+        ClosureNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4)])
+        self.assertClosureConsistent()
+        self.assertEqual(p[1].distance(p[4]), 2)
+
+    def test_04_bulk_detach(self):
+        p = self.p
+        # Updates the maintained tables edge by edge
+        ClosureNode.dag_rebuild_ratio = None
+        try:
+            ClosureNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4), (5, 4), (4, 6), (6, 7)])
+            self.assertEqual(ClosureNode.remove_edges([(1, 3), (5, 4)]), 2)
+            self.assertClosureConsistent()
+            p[4].detach_all_parents()
+            self.assertClosureConsistent()
+            self.assertEqual(p[4].delete_subgraph(), 3)
+            self.assertClosureConsistent()
+            self.assertEqual(sorted(n.pk for n in p[1].descendants()), [2, 3])
+        finally:
+            del ClosureNode.dag_rebuild_ratio
+
+    def test_05_deep_lattice(self):
+        # 2 ** 70 paths from the first layer to the last one
+        ClosureNode.objects.bulk_create([ClosureNode(pk=i, name='%s' % i) for i in range(8, 143)])
+        ClosureNode.bulk_add_edges(benchmark.lattice(140))
+        p = dict((i, ClosureNode.objects.get(pk=i)) for i in (1, 139, 140, 141, 142))
+        p[139].add_child(p[141])
+        p[140].add_child(p[141])
+        p[141].add_child(p[142])
+        self.assertEqual(p[1].distance(p[142]), 71)
+        p[139].remove_child(p[141])
+        self.assertClosureConsistent()
+        self.assertEqual(p[1].distance(p[142]), 71)
+        p[140].remove_child(p[141])
+        self.assertFalse(p[1].is_ancestor_of(p[142]))
+        self.assertClosureConsistent()
+
+    def test_06_move_edge(self):
+        p = self.p
+        ClosureNode.bulk_add_edges([(1, 2), (2, 4), (3, 5)])
+        edge = ClosureEdge.objects.get(parent=1, child=2)
+        edge.child = p[3]
+        edge.save()
+        self.assertClosureConsistent()
+        self.assertEqual(sorted(n.pk for n in p[1].descendants()), [3, 5])
+        edge.parent = p[5]
+        self.assertRaises(ValidationError, edge.save)
+
+    def test_07_bulk_remove(self):
+        p = self.p
+        ClosureNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4), (4, 5)])
+        ClosureEdgeNote.objects.create(edge=ClosureEdge.objects.get(parent=2, child=3))
+        deleted = []
+        receiver = lambda sender, instance, **kwargs: deleted.append(instance._dag_node_pks())
+        post_delete.connect(receiver, sender=ClosureEdge)
+        try:
+            self.assertEqual(ClosureNode.remove_edges([(2, 3), (1, 3)]), 2)
+            self.assertEqual(p[4].detach_all_children(), 1)
+        finally:
+            post_delete.disconnect(receiver, sender=ClosureEdge)
+        # Signals and cascades as with Edge.delete()
+        self.assertEqual(sorted(deleted), [(1, 3), (2, 3), (4, 5)])
+        self.assertFalse(ClosureEdgeNote.objects.exists())
+        self.assertClosureConsistent()
+        self.assertEqual(sorted(n.pk for n in p[1].descendants()), [2])
+
+    def test_08_incremental_removal(self):
+        p = self.p
+        ClosureNode.bulk_add_edges([(1, 2), (1, 3), (3, 4), (2, 5), (4, 5)])
+        kept = dict(((a, d, depth), pk) for pk, a, d, depth in ConcreteClosure.objects.filter(
+            descendant__in=[3, 4]).values_list('pk', 'ancestor', 'descendant', 'depth'))
+        p[1].remove_child(p[2])
+        # The rows beside the removed edge are left as they are
+        self.assertEqual(kept, dict(((a, d, depth), pk) for pk, a, d, depth in ConcreteClosure.objects.filter(
+            descendant__in=[3, 4]).values_list('pk', 'ancestor', 'descendant', 'depth')))
+        self.assertClosureConsistent()
+
+        ClosureEdge.objects.all().delete()
+        ClosureNode.objects.bulk_create([ClosureNode(pk=i, name='%s' % i) for i in range(8, 41)])
+        ClosureNode.bulk_add_edges(benchmark.random_dag(40, edges=120, seed=1))
+        ClosureNode.dag_rebuild_ratio = None
+        try:
+            rng = random.Random(1)
+            for step in range(8):
+                pairs = list(ClosureEdge.objects.values_list('parent', 'child'))
+                ClosureNode.remove_edges(rng.sample(pairs, step % 3 + 1))
+                self.assertClosureConsistent()
+            ClosureNode.objects.get(pk=20).delete()
+            self.assertClosureConsistent()
+        finally:
+            del ClosureNode.dag_rebuild_ratio
+
+    def test_09_rebuild_ratio(self):
+        ClosureNode.objects.bulk_create([ClosureNode(pk=i, name='%s' % i) for i in range(8, 31)])
+        ClosureNode.bulk_add_edges([(i, i + 1) for i in range(1, 30)])
+        pairs = [(i, i + 1) for i in range(1, 30)]
+        # Up to a tenth of the 29 edges is updated edge by edge
+        self.assertFalse(ClosureNode._dag_rebuild_batch(pairs[:2]))
+        self.assertTrue(ClosureNode._dag_rebuild_batch(pairs[:3]))
+        self.assertEqual(ClosureNode.remove_edges(pairs[:10]), 10)
+        self.assertClosureConsistent()
+        ClosureNode.dag_rebuild_ratio = None
+        try:
+            self.assertFalse(ClosureNode._dag_rebuild_batch(pairs))
+        finally:
+            del ClosureNode.dag_rebuild_ratio
+
+
+class DenormalizedTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(1, 8):
+            CountedNode(name="%s" % i).save()
+
+    def assertDenormalized(self):
+        stored = dict((n.pk, (n.child_count, n.parent_count, n.min_depth, n.max_depth))
+                      for n in CountedNode.objects.all())
+        CountedNode.rebuild_denormalized()
+        rebuilt = dict((n.pk, (n.child_count, n.parent_count, n.min_depth, n.max_depth))
+                       for n in CountedNode.objects.all())
+        self.assertEqual(stored, rebuilt)
+
+    def test_01_maintenance(self):
+        p = dict((i, CountedNode.objects.get(pk=i)) for i in range(1, 8))
+        p[1].add_child(p[2])
+        p[2].add_child(p[3])
+        p[3].add_child(p[4])
+        p[1].add_child(p[4])
+        p[5].add_child(p[4])
+        self.assertDenormalized()
+        self.assertEqual(CountedNode.objects.values_list('min_depth', 'max_depth').get(pk=4), (1, 3))
+        # Predicates use the loaded fields
+        with self.assertNumQueries(0):
+            self.assertTrue(p[1].is_root())
+            self.assertTrue(p[4].is_leaf())
+            self.assertFalse(p[2].is_leaf())
+            self.assertTrue(p[6].is_island())
+        self.assertEqual(sorted(n.pk for n in CountedNode.objects.roots()), [1, 5])
+        self.assertEqual(sorted(n.pk for n in CountedNode.objects.leaves()), [4])
+        self.assertEqual(sorted(n.pk for n in CountedNode.objects.islands()), [6, 7])
+
+        p[2].remove_child(p[3])
+        self.assertTrue(p[2].is_leaf())
+        self.assertDenormalized()
+        self.assertEqual(CountedNode.objects.values_list('min_depth', 'max_depth').get(pk=4), (1, 1))
+
+        CountedEdge.objects.filter(child=p[4]).delete()
+        self.assertDenormalized()
+        p[1].delete()
+        self.assertDenormalized()
+        self.assertEqual(sorted(n.pk for n in CountedNode.objects.islands()), [2, 3, 4, 5, 6, 7])
+
+    def test_02_bulk_add_edges(self):
+        # Updates the maintained tables edge by edge
+        CountedNode.dag_rebuild_ratio = None
+        try:
+            CountedNode.bulk_add_edges([(1, 2), (2, 3), (1, 3), (3, 4), (5, 4)])
+            self.assertDenormalized()
+            self.assertEqual(CountedNode.objects.filter(max_depth=3).get().pk, 4)
+            CountedNode.remove_edges([(2, 3)])
+            self.assertDenormalized()
+            CountedNode.objects.get(pk=3).delete_subgraph()
+            self.assertDenormalized()
+            self.assertEqual(sorted(n.pk for n in CountedNode.objects.islands()), [5, 6, 7])
+        finally:
+            del CountedNode.dag_rebuild_ratio
+
+    def test_03_move_edge(self):
+        p = dict((i, CountedNode.objects.get(pk=i)) for i in range(1, 8))
+        CountedNode.bulk_add_edges([(1, 2), (2, 3)])
+        edge = CountedEdge.objects.get(parent=1, child=2)
+        edge.parent = p[4]
+        edge.save()
+        self.assertDenormalized()
+        self.assertEqual(CountedNode.objects.values_list('child_count', 'parent_count').get(pk=1), (0, 0))
+        self.assertEqual(CountedNode.objects.values_list('child_count', 'max_depth').get(pk=4), (1, 0))
+
+    def test_04_stale_save(self):
+        node = CountedNode.objects.get(pk=1)
+        CountedNode.bulk_add_edges([(1, 2), (1, 3)])
+        node.name = 'renamed'
+        node.save()
+        node = CountedNode.objects.get(pk=1)
+        self.assertEqual((node.name, node.child_count), ('renamed', 2))
+        self.assertTrue(node.is_root())
+        node.save(update_fields=['name', 'child_count'])
+        self.assertEqual(CountedNode.objects.get(pk=1).child_count, 2)
+
+
+class ReachabilityTestCase(TestCase):
+
+    def setUp(self):
+        for i in range(1, 8):
+            IndexedNode(name="%s" % i).save()
+        self.p = dict((i, IndexedNode.objects.get(pk=i)) for i in range(1, 8))
+
+    def assertIndexExact(self):
+        for i, node in self.p.items():
+            descendants = node.descendants_set(ids_only=True)
+            for j in self.p:
+                self.assertEqual(ConcreteReachability.reaches(i, j), j in descendants, (i, j))
+
+    def test_01_maintenance(self):
+        p = self.p
+        p[1].add_child(p[2])
+        p[1].add_child(p[3])
+        p[2].add_child(p[4])
+        p[3].add_child(p[4])
+        p[4].add_child(p[5])
+        p[6].add_child(p[3])
+        self.assertIndexExact()
+        with self.assertNumQueries(1):
+            self.assertTrue(p[5].is_descendant_of(p[6]))
+        with self.assertNumQueries(1):
+            self.assertRaises(NodeNotReachableException, p[2].path, p[3])
+        self.assertEqual(p[6].path(p[5]), [p[3], p[4], p[5]])
+        self.assertRaises(ValidationError, p[5].add_child, p[1])
+
+        p[3].remove_child(p[4])
+        self.assertIndexExact()
+        self.assertFalse(p[6].is_ancestor_of(p[5]))
+        IndexedNode.remove_edges([(1, 2)])
+        self.assertIndexExact()
+        p[4].delete()
+        del p[4]
+        self.assertIndexExact()
+        IndexedNode.bulk_add_edges([(7, 1), (5, 6)])
+        self.assertIndexExact()
+
+    def test_02_rebuild(self):
+        IndexedNode.bulk_add_edges([(i, j) for i in range(1, 8) for j in range(i + 1, 8)])
+        self.assertIndexExact()
+        ConcreteReachability.objects.all().delete()
+        self.assertFalse(self.p[1].is_ancestor_of(self.p[2]))
+        call_command('dag_reachability', 'django_dag.IndexedNode', stdout=StringIO())
+        self.assertIndexExact()
+        # A transitive tournament is a single interval per node
+        self.assertEqual(ConcreteReachability.objects.count(), 7)
+
+    def test_03_move_edge(self):
+        IndexedNode.bulk_add_edges([(1, 2), (2, 3), (4, 5)])
+        edge = IndexedEdge.objects.get(parent=2, child=3)
+        edge.parent = self.p[5]
+        edge.save()
+        self.assertIndexExact()
+        self.assertFalse(self.p[1].is_ancestor_of(self.p[3]))
+        self.assertTrue(self.p[4].is_ancestor_of(self.p[3]))
+
+    def test_04_many_parents(self):
+        # Updates the maintained tables edge by edge
+        IndexedNode.dag_rebuild_ratio = None
+        try:
+            IndexedNode.objects.bulk_create([IndexedNode(pk=i, name='%s' % i) for i in range(8, 1509)])
+            IndexedNode.bulk_add_edges([(i, 1) for i in range(8, 608)] + [(2, i) for i in range(608, 1509)])
+            self.assertEqual(IndexedNode.remove_edges([(i, 1) for i in range(8, 607)]), 599)
+            self.assertTrue(ConcreteReachability.reaches(607, 1))
+            self.assertFalse(ConcreteReachability.reaches(8, 1))
+            self.assertEqual(self.p[2].delete_subgraph(), 902)
+            self.assertIndexExact()
+        finally:
+            del IndexedNode.dag_rebuild_ratio
@@ -0,0 +1,222 @@
+"""
+Streaming export and import of the edge table.
+
+Edges are written, and read back, chunk_size at a time as:
+
+- 'ndjson': one JSON object per line, {"parent": ..., "child": ...}
+  plus the extra fields of the edge model
+- 'csv': a parent,child,... header then one row per edge
+- 'binary': the DAGE1 magic then little endian signed 64-bit
+  (parent, child) pairs, for integer keys only
+
+Nodes are identified by the key field, the primary key by default: a
+unique field such as a slug moves graphs between databases numbering
+nodes differently. Reads and writes hold one chunk at a time; the import
+checks the whole graph for cycles once, on its primary key pairs, and
+rolls back if any is found. The dag_export and dag_import management
+commands wrap export_edges() and import_edges().
+"""
+
+import csv
+import json
+import struct
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, router, transaction
+
+from .cache import invalidate_model
+from .graph import cycle_edges, topological_sort
+
+FORMATS = ('ndjson', 'csv', 'binary')
+
+BINARY_MAGIC = b'DAGE1'
+BINARY_PAIR = struct.Struct('<qq')
+
+
+def _extra_fields(edge_model):
+    """
+    Returns the concrete fields of the edge model besides the key, the
+    parent and the child
+    """
+    return [f for f in edge_model._meta.concrete_fields
+            if not f.primary_key and f.name not in ('parent', 'child')]
+
+
+def _key_field(node_model, key):
+    return node_model._meta.pk if key == 'pk' else node_model._meta.get_field(key)
+
+
+def check_format(node_model, format, key='pk'):
+    """
+    Raises ValueError for an unknown format, or for the binary format
+    with a key field that doesn't hold integers
+    """
+    if format not in FORMATS:
+        raise ValueError('Unknown format %r, expected one of %s' % (format, ', '.join(FORMATS)))
+    field = _key_field(node_model, key)
+    if format == 'binary' and not isinstance(field, (models.IntegerField, models.AutoField)):
+        raise ValueError('The binary format needs integer keys, %s.%s is a %s' % (
+            node_model.__name__, field.name, field.get_internal_type()))
+
+
+def iter_edges(node_model, key='pk', chunk_size=2000):
+    """
+    Yields a dict per edge with the parent and child keys and the extra
+    fields, reading the edge table chunk_size rows at a time by primary
+    key ranges
+    """
+    edge_model = node_model.children.through
+    names = [f.attname for f in _extra_fields(edge_model)]
+    columns = ['parent__%s' % key, 'child__%s' % key] + names
+    edges = edge_model.objects.order_by('pk')
+    last = None
+    while True:
+        rows = edges if last is None else edges.filter(pk__gt=last)
+        rows = list(rows.values_list('pk', *columns)[:chunk_size])
+        for row in rows:
+            edge = dict(zip(names, row[3:]))
+            edge['parent'], edge['child'] = row[1], row[2]
+            yield edge
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][0]
+
+
+def export_edges(node_model, stream, format='ndjson', key='pk', chunk_size=2000):
+    """
+    Writes the edges of node_model to stream, a text stream or a binary
+    one for the binary format, returns the number of edges written
+    """
+    check_format(node_model, format, key)
+    names = [f.attname for f in _extra_fields(node_model.children.through)]
+    count = 0
+    if format == 'binary':
+        stream.write(BINARY_MAGIC)
+    elif format == 'csv':
+        writer = csv.writer(stream, lineterminator='\n')
+        writer.writerow(['parent', 'child'] + names)
+    for edge in iter_edges(node_model, key, chunk_size):
+        if format == 'binary':
+            stream.write(BINARY_PAIR.pack(edge['parent'], edge['child']))
+        elif format == 'csv':
+            writer.writerow([edge['parent'], edge['child']] + ['' if edge[n] is None else edge[n] for n in names])
+        else:
+            stream.write(json.dumps(edge, cls=DjangoJSONEncoder, sort_keys=True) + '\n')
+        count += 1
+    return count
+
+
+def read_edges(stream, format='ndjson', chunk_size=2000):
+    """
+    Yields the edge dicts written by export_edges(), values of the csv
+    format are strings
+    """
+    if format == 'binary':
+        if stream.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError('Not a binary edge list')
+        while True:
+            data = stream.read(BINARY_PAIR.size * chunk_size)
+            if len(data) % BINARY_PAIR.size:
+                raise ValueError('Truncated binary edge list')
+            for offset in range(0, len(data), BINARY_PAIR.size):
+                parent, child = BINARY_PAIR.unpack_from(data, offset)
+                yield {'parent': parent, 'child': child}
+            if len(data) < BINARY_PAIR.size * chunk_size:
+                return
+    elif format == 'csv':
+        for row in csv.DictReader(stream):
+            yield row
+    elif format == 'ndjson':
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError('Unknown format %r, expected one of %s' % (format, ', '.join(FORMATS)))
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _map_keys(node_model, key, values, create_missing):
+    """
+    Returns a dict mapping key values to node primary keys, creating
+    the missing nodes with only their key set if create_missing
+    """
+    lookup = '%s__in' % key
+    mapping = dict(node_model.objects.filter(**{lookup: values}).values_list(key, 'pk'))
+    missing = [v for v in values if v not in mapping]
+    if missing and not create_missing:
+        raise ValidationError('Unknown nodes: %(keys)s.', code='missing',
+                              params={'keys': ', '.join(str(v) for v in sorted(missing)[:20])})
+    if missing:
+        node_model.objects.bulk_create([node_model(**{key: v}) for v in missing], batch_size=500)
+        mapping.update(node_model.objects.filter(**{lookup: missing}).values_list(key, 'pk'))
+    return mapping
+
+
+def import_edges(node_model, stream, format='ndjson', key='pk', create_missing=False, chunk_size=2000):
+    """
+    Adds the edges read from stream, written by export_edges(), in
+    chunks of chunk_size edges, returns the number of edges added.
+
+    Keys are looked up chunk by chunk; unknown nodes raise a
+    ValidationError unless create_missing. The graph is checked for
+    cycles once all the edges are in, a ValidationError lists the edges
+    on cycles and nothing is imported. The closure, the reachability
+    index and the denormalized fields are rebuilt, the cached results
+    of node_model dropped.
+    """
+    check_format(node_model, format, key)
+    edge_model = node_model.children.through
+    field = _key_field(node_model, key)
+    extra = dict((f.attname, f) for f in _extra_fields(edge_model))
+    parent_field, child_field = node_model._dag_edge_fields()
+    count = 0
+    with transaction.atomic(using=router.db_for_write(edge_model)):
+        for rows in _chunks(read_edges(stream, format, chunk_size), chunk_size):
+            for row in rows:
+                row['parent'] = field.to_python(row['parent'])
+                row['child'] = field.to_python(row['child'])
+            mapping = _map_keys(node_model, key, list(set(r['parent'] for r in rows) |
+                                                       set(r['child'] for r in rows)), create_missing)
+            pairs = [(mapping[r['parent']], mapping[r['child']]) for r in rows]
+            edges = []
+            for row, values in zip(rows, node_model._dag_edge_values(pairs)):
+                edge = edge_model()
+                for name, value in row.items():
+                    if name in extra:
+                        if value == '' and extra[name].null:
+                            value = None
+                        setattr(edge, name, extra[name].to_python(value))
+                for f, value in zip((parent_field, child_field), values):
+                    setattr(edge, f.attname, value)
+                edges.append(edge)
+            edge_model.objects.bulk_create(edges, batch_size=500)
+            count += len(edges)
+
+        children = node_model._dag_graph()
+        order, cyclic = topological_sort(children)
+        if cyclic:
+            cyclic = set(cyclic)
+            pairs = [(p, c) for p in cyclic for c in children[p] if c in cyclic]
+            raise ValidationError([
+                ValidationError('The edge %(parent)s -> %(child)s creates a cycle.', code='cycle',
+                                params={'parent': p, 'child': c})
+                for p, c in sorted(cycle_edges(children, pairs))])
+
+        for index in (node_model._dag_closure_model(), node_model._dag_reachability_model()):
+            if index is not None:
+                index.rebuild()
+        if node_model.dag_denormalized:
+            node_model.rebuild_denormalized()
+        invalidate_model(node_model)
+    return count
@@ -29,7 +29,8 @@ setup(
     author='Alessandro Pasotti',
     author_email='apasotti@gmail.com',
     license='GNU Affero General Public License v3',
-    packages=['django_dag'],
+    packages=['django_dag', 'django_dag.management', 'django_dag.management.commands',
+              'django_dag.templatetags'],
     package_dir={'django_dag': 'django_dag'},
     #package_data={'dag': ['templates/admin/*.html']},
     description='Directed Acyclic Graph implementation for Django 1.6+',